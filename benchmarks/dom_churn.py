@@ -0,0 +1,50 @@
+# replaces part of a page over and over from js and prints how much memory the page holds on to.
+# with leak-free handles the numbers should stay flat instead of growing every round
+#
+#   python benchmarks/dom_churn.py [rounds]
+
+import gc
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import web_browser
+
+PAGE = '<html><body><div>start</div></body></html>'
+
+CHURN_JS = '''
+var div = document.querySelectorAll('div')[0];
+var html = '';
+for (var i = 0; i < 50; i++) {
+    html += '<p>paragraph ' + i + ' <b>bold</b> <i>italic</i></p>';
+}
+div.innerHTML = html;
+var ps = document.querySelectorAll('p');
+for (var i = 0; i < ps.length; i++) {
+    ps[i].addEventListener('click', function() {});
+}
+'''
+
+def main(rounds):
+    tab = web_browser.Tab(None, web_browser.HEIGHT)
+    tab.url = web_browser.Url('http://localhost:8000/')
+    tab.dom_index = web_browser.DomIndex()
+    tab.nodes = web_browser.HtmlParser(PAGE, tab.dom_index).parse()
+    tab.js = web_browser.JsContext()
+    tab.js.attach(tab)
+
+    tracemalloc.start()
+    print('{:>6} {:>12} {:>10} {:>10}'.format('round', 'traced KiB', 'handles', 'js refs'))
+    for i in range(1, rounds + 1):
+        tab.js.run('churn', CHURN_JS)
+        if i % (rounds // 10 or 1) == 0:
+            gc.collect()
+            current, peak = tracemalloc.get_traced_memory()
+            print('{:>6} {:>12.1f} {:>10} {:>10}'.format(
+                i, current / 1024, len(tab.js.handle_to_node), len(tab.js.js_refs)))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,93 @@
+# measures how long Tab.load and the first render take for a page, served from a recorded network archive so
+# that runs don't depend on a server or the internet. record once against a live server, then replay as often
+# as needed with the latency and bandwidth to simulate
+#
+#   python benchmarks/page_load.py record http://localhost:8000/ page.jsonl
+#   python benchmarks/page_load.py replay page.jsonl [--latency-ms N] [--bandwidth BYTES] [--repeat N] [--out F]
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import web_browser
+
+web_browser.HEADLESS_FONTS = True
+
+def load(url):
+    tab = web_browser.Tab(None, web_browser.HEIGHT)
+    start = time.perf_counter()
+    tab.load(url)
+    loaded = time.perf_counter()
+    tab.render()
+    rendered = time.perf_counter()
+    tab.js.close()
+    return (loaded - start) * 1000, (rendered - start) * 1000
+
+def record(args):
+    web_browser.use_network_archive(args.archive, False)
+    load_ms, render_ms = load(web_browser.Url(args.url))
+    with open(args.archive) as f:
+        requests = sum(1 for line in f if 'navigation' not in json.loads(line))
+    print('recorded {} requests to {} in {:.1f} ms'.format(requests, args.archive, render_ms))
+
+def replay(args):
+    # the page that was recorded, which isn't necessarily the first response in the archive: preloaded subresources
+    # can finish downloading before the page does
+    navigations = web_browser.NetworkArchive(args.archive, True).navigations
+    if not navigations:
+        sys.exit('{} has no recorded page load, record it again'.format(args.archive))
+    url = navigations[0]
+
+    load_times, render_times = [], []
+    for _ in range(args.repeat):
+        # a fresh archive and cookie jar each time, so every run sees the same responses
+        web_browser.COOKIE_JAR.clear()
+        web_browser.use_network_archive(args.archive, True, args.latency_ms, args.bandwidth)
+        load_ms, render_ms = load(web_browser.Url(url))
+        load_times.append(load_ms)
+        render_times.append(render_ms)
+
+    results = {
+        'url': url,
+        'latency_ms': args.latency_ms,
+        'bandwidth': args.bandwidth,
+        'repeat': args.repeat,
+        'load_ms': {'min': min(load_times), 'median': statistics.median(load_times)},
+        'load_and_render_ms': {'min': min(render_times), 'median': statistics.median(render_times)},
+    }
+    print('{} at {} ms latency, {} bytes/s'.format(url, args.latency_ms, args.bandwidth or 'unlimited'))
+    print('  load           {:>8.1f} ms median {:>8.1f} ms min'.format(
+        results['load_ms']['median'], results['load_ms']['min']))
+    print('  load + render  {:>8.1f} ms median {:>8.1f} ms min'.format(
+        results['load_and_render_ms']['median'], results['load_and_render_ms']['min']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description='time page loads against a recorded network archive')
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_parser = commands.add_parser('record', help='load a page from the network and record it')
+    record_parser.add_argument('url')
+    record_parser.add_argument('archive')
+    replay_parser = commands.add_parser('replay', help='time loading a recorded page')
+    replay_parser.add_argument('archive')
+    replay_parser.add_argument('--latency-ms', type=float, default=0)
+    replay_parser.add_argument('--bandwidth', type=float, help='bytes per second, unlimited if not given')
+    replay_parser.add_argument('--repeat', type=int, default=10)
+    replay_parser.add_argument('--out', help='save the results to this json file')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args)
+    else:
+        replay(args)
+
+if __name__ == '__main__':
+    main()
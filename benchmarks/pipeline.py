@@ -0,0 +1,195 @@
+# times each stage of the rendering pipeline (html parsing, css parsing, style, layout, paint) on a generated
+# page, then the whole thing end to end, and saves the results as json so runs on different commits can be
+# compared. no window is needed, text is measured with web_browser.HeadlessFont
+#
+#   python benchmarks/pipeline.py [--size N] [--depth N] [--rules N] [--inline-styles F] [--out results.json]
+#   python benchmarks/pipeline.py --compare old.json new.json
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import web_browser
+
+web_browser.HEADLESS_FONTS = True
+
+BLOCK_TAGS = ['div', 'section', 'article']
+INLINE_TAGS = ['b', 'i', 'a', 'span']
+COLORS = ['black', 'red', 'green', 'blue', 'gray', 'orange']
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+         'et dolore magna aliqua').split()
+
+# a random property: value pair, as it would appear in a style sheet or a style attribute
+def random_declaration(rng):
+    property = rng.choice(['color', 'background-color', 'font-weight', 'font-style', 'font-size'])
+    if property in ('color', 'background-color'):
+        value = rng.choice(COLORS)
+    elif property == 'font-weight':
+        value = rng.choice(['normal', 'bold'])
+    elif property == 'font-style':
+        value = rng.choice(['normal', 'italic'])
+    else:
+        value = '{}px'.format(rng.randint(10, 24))
+    return '{}: {}'.format(property, value)
+
+# size paragraphs spread over blocks nested depth deep, with inline_styles of the paragraphs carrying a style
+# attribute, plus a style sheet with rules tag and descendant selectors
+def generate_page(size, depth, rules, inline_styles, seed=0):
+    rng = random.Random(seed)
+
+    def paragraph():
+        words = []
+        for _ in range(rng.randint(10, 40)):
+            word = rng.choice(WORDS)
+            if rng.random() < 0.1:
+                tag = rng.choice(INLINE_TAGS)
+                word = '<{0}>{1}</{0}>'.format(tag, word)
+            words.append(word)
+        style = ''
+        if rng.random() < inline_styles:
+            style = ' style="{}"'.format('; '.join(random_declaration(rng) for _ in range(rng.randint(1, 3))))
+        return '<p{}>{}</p>'.format(style, ' '.join(words))
+
+    def block(level, count):
+        if level == depth or count <= 1:
+            return ''.join(paragraph() for _ in range(count))
+        tag = rng.choice(BLOCK_TAGS)
+        half = count // 2
+        return '<{0}>{1}{2}</{0}>'.format(tag, block(level + 1, half), block(level + 1, count - half))
+
+    html = '<html><head></head><body>{}</body></html>'.format(block(0, size))
+
+    tags = BLOCK_TAGS + INLINE_TAGS + ['p']
+    css = []
+    for _ in range(rules):
+        selector = rng.choice(tags)
+        if rng.random() < 0.5:
+            selector = rng.choice(BLOCK_TAGS) + ' ' + selector
+        css.append('{} {{ {}; }}'.format(selector, random_declaration(rng)))
+    return html, '\n'.join(css)
+
+# runs fn repeat times and returns timing stats in milliseconds
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'min_ms': min(times), 'median_ms': statistics.median(times), 'max_ms': max(times)}
+
+def run(args):
+    html, css = generate_page(args.size, args.depth, args.rules, args.inline_styles, args.seed)
+    default_rules = web_browser.default_style_sheet()
+
+    # each stage gets the output of the one before it, made once up front
+    nodes = web_browser.HtmlParser(html).parse()
+    rules = sorted(default_rules + web_browser.CssParser(css).parse(), key=web_browser.cascade_priority)
+    web_browser.style(nodes, rules)
+    document = web_browser.DocumentLayout(nodes)
+    document.layout()
+
+    def end_to_end():
+        nodes = web_browser.HtmlParser(html).parse()
+        rules = sorted(default_rules + web_browser.CssParser(css).parse(), key=web_browser.cascade_priority)
+        web_browser.style(nodes, rules)
+        document = web_browser.DocumentLayout(nodes)
+        document.layout()
+        web_browser.paint_tree(document, web_browser.DisplayList())
+
+    def layout():
+        web_browser.DocumentLayout(nodes).layout()
+
+    stages = {
+        'parse_html': lambda: web_browser.HtmlParser(html).parse(),
+        'parse_css': lambda: web_browser.CssParser(css).parse(),
+        'style': lambda: web_browser.style(nodes, rules),
+        'layout': layout,
+        'paint': lambda: web_browser.paint_tree(document, web_browser.DisplayList()),
+        'end_to_end': end_to_end,
+    }
+
+    display_list = web_browser.DisplayList()
+    web_browser.paint_tree(document, display_list)
+    words = sum(len(node.text.split()) for node in web_browser.tree_to_list(nodes, [])
+                if isinstance(node, web_browser.Text))
+    results = {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'page': {'size': args.size, 'depth': args.depth, 'rules': args.rules, 'inline_styles': args.inline_styles,
+                 'seed': args.seed, 'html_bytes': len(html), 'css_bytes': len(css),
+                 'dom_nodes': len(web_browser.tree_to_list(nodes, [])), 'words': words,
+                 'layout_objects': len(web_browser.tree_to_list(document, [])),
+                 'display_list_commands': len(display_list)},
+        'repeat': args.repeat,
+        'stages': {},
+    }
+    for name, fn in stages.items():
+        fn() # warm up caches, e.g. fonts
+        results['stages'][name] = measure(fn, args.repeat)
+    for name in ('layout', 'end_to_end'):
+        stats = results['stages'][name]
+        stats['words_per_sec'] = words / (stats['median_ms'] / 1000)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    page = results['page']
+    print('commit {}, {} paragraphs, depth {}, {} rules, {:.0%} inline styles: {} nodes, {} commands'.format(
+        results['commit'], page['size'], page['depth'], page['rules'], page['inline_styles'], page['dom_nodes'],
+        page['display_list_commands']))
+    for name, stats in results['stages'].items():
+        line = '{:>12} {:>10.2f} ms median {:>10.2f} ms min'.format(name, stats['median_ms'], stats['min_ms'])
+        if 'words_per_sec' in stats:
+            line += ' {:>12,.0f} words/s'.format(stats['words_per_sec'])
+        print(line)
+
+# prints how much each stage's median changed between two saved runs
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print('{} -> {}'.format(old['commit'], new['commit']))
+    for name, stats in new['stages'].items():
+        if name not in old['stages']:
+            continue
+        before, after = old['stages'][name]['median_ms'], stats['median_ms']
+        print('{:>12} {:>10.2f} ms -> {:>10.2f} ms {:>+8.1%}'.format(name, before, after, after / before - 1))
+
+def main():
+    parser = argparse.ArgumentParser(description='time the rendering pipeline on a generated page')
+    parser.add_argument('--size', type=int, default=200, help='number of paragraphs')
+    parser.add_argument('--depth', type=int, default=4, help='how deeply blocks are nested')
+    parser.add_argument('--rules', type=int, default=50, help='number of style sheet rules')
+    parser.add_argument('--inline-styles', type=float, default=0.2,
+                        help='fraction of paragraphs with a style attribute')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--out', help='save the results to this json file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved results')
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(*args.compare)
+    results = run(args)
+    print_results(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
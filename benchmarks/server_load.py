@@ -0,0 +1,108 @@
+# load test for server/simple_web_server.py. a number of clients request the guest book page and its
+# subresources in parallel, and the requests per second and latencies are printed. slow clients open a
+# connection and never finish their request, each one tying up a server worker until its request times out.
+# with --keep-alive each client sends all its requests over one http/1.1 connection instead of opening a new
+# one per request
+#
+#   python benchmarks/server_load.py [--clients N] [--requests N] [--slow-clients N] [--keep-alive] [--port N]
+
+import argparse
+import socket
+import statistics
+import threading
+import time
+
+PATHS = ['/', '/comment.js', '/comment.css']
+
+# one GET over a new connection, returns the status code
+def get(host, port, path):
+    s = socket.create_connection((host, port))
+    try:
+        s.sendall('GET {} HTTP/1.0\r\nHost: {}\r\n\r\n'.format(path, host).encode('utf8'))
+        response = s.makefile('rb')
+        status = int(response.readline().split()[1])
+        response.read() # the server closes the connection after the body
+        return status
+    finally:
+        s.close()
+
+# one GET over an open http/1.1 connection, returns the status code. the body is read by its content-length,
+# leaving the connection ready for the next request
+def get_keep_alive(s, response, host, path):
+    s.sendall('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(path, host).encode('utf8'))
+    status = int(response.readline().split()[1])
+    length = 0
+    while True:
+        line = response.readline()
+        if line == b'\r\n':
+            break
+        header, value = line.decode('utf8').split(':', 1)
+        if header.casefold() == 'content-length':
+            length = int(value)
+    response.read(length)
+    return status
+
+def client(args, latencies, errors):
+    if args.keep_alive:
+        s = socket.create_connection((args.host, args.port))
+        response = s.makefile('rb')
+        get_one = lambda path: get_keep_alive(s, response, args.host, path)
+    else:
+        get_one = lambda path: get(args.host, args.port, path)
+    try:
+        for i in range(args.requests):
+            path = PATHS[i % len(PATHS)]
+            start = time.perf_counter()
+            try:
+                if get_one(path) != 200:
+                    errors.append(path)
+            except OSError as e:
+                errors.append(e)
+                if args.keep_alive:
+                    break # the connection is gone
+                continue
+            latencies.append(time.perf_counter() - start)
+    finally:
+        if args.keep_alive:
+            s.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='load test the guest book server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--clients', type=int, default=16, help='clients sending requests at the same time')
+    parser.add_argument('--requests', type=int, default=100, help='requests each client sends')
+    parser.add_argument('--slow-clients', type=int, default=0,
+                        help='connections that send half a request line and then wait')
+    parser.add_argument('--keep-alive', action='store_true', help='send each client\'s requests over one connection')
+    args = parser.parse_args()
+
+    slow = []
+    for _ in range(args.slow_clients):
+        s = socket.create_connection((args.host, args.port))
+        s.sendall(b'GET / HT')
+        slow.append(s)
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client, args=(args, latencies, errors)) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for s in slow:
+        s.close()
+
+    latencies.sort()
+    print('{} clients x {} requests, {} slow clients, {}'.format(args.clients, args.requests, args.slow_clients,
+                                                               'keep-alive' if args.keep_alive else 'one request per connection'))
+    print('{:>10.0f} requests/s ({} in {:.2f} s, {} errors)'.format(len(latencies) / elapsed, len(latencies),
+                                                                    elapsed, len(errors)))
+    if latencies:
+        print('{:>10.2f} ms median latency'.format(statistics.median(latencies) * 1000))
+        print('{:>10.2f} ms p99 latency'.format(latencies[int(len(latencies) * 0.99)] * 1000))
+
+if __name__ == '__main__':
+    main()
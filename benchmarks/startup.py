@@ -0,0 +1,56 @@
+# imports web_browser in fresh interpreters with -X importtime and prints how long it took, which modules
+# cost the most, and whether any of the modules that are supposed to load lazily got imported anyway.
+# it runs from a different working directory, since importing shouldn't depend on where you start
+#
+#   python benchmarks/startup.py [runs]
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# none of these should be imported until a window, a js context or an https request needs them
+LAZY_MODULES = ['tkinter', 'dukpy', 'ssl', 'multiprocessing', 'concurrent.futures']
+
+CODE = '''
+import sys
+sys.path.insert(0, {root!r})
+import web_browser
+print(' '.join(m for m in {lazy!r} if m in sys.modules))
+'''.format(root=ROOT, lazy=LAZY_MODULES)
+
+# runs one import, returns {module: (self us, cumulative us)} and the lazy modules that were imported
+def import_once(cwd):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None) # measure startup with the bytecode cache, like a real install
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', CODE], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times, result.stdout.split()
+
+def main(runs):
+    with tempfile.TemporaryDirectory() as cwd:
+        import_once(cwd) # compile and cache the bytecode first
+        samples = [import_once(cwd) for _ in range(runs)]
+
+    totals = [times['web_browser'][1] / 1000 for times, lazy in samples]
+    print('import web_browser: median {:.1f} ms, min {:.1f} ms over {} runs'.format(
+        statistics.median(totals), min(totals), runs))
+
+    times, lazy = samples[-1]
+    print('\nslowest modules (cumulative ms):')
+    for name, (self_us, cumulative_us) in sorted(times.items(), key=lambda item: -item[1][1])[:10]:
+        print('{:>8.1f}  {}'.format(cumulative_us / 1000, name))
+
+    print('\nlazy modules imported at startup:', ' '.join(lazy) or 'none')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
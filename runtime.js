@@ -6,9 +6,30 @@ console = {
     }
 }
 
-// wraps a handle
+// tells the browser when a Node object is garbage collected, so that it can let go of the element
+var NODE_FINALIZER = typeof FinalizationRegistry !== 'undefined' ?
+    new FinalizationRegistry(function(handle) {
+        call_python('releaseHandle', handle);
+    }) : null;
+
+// wraps a handle. the browser hands out one reference per handle it returns, so there must be exactly one
+// Node object per returned handle
 function Node(handle) {
     this.handle = handle;
+    if (NODE_FINALIZER) {
+        NODE_FINALIZER.register(this, handle);
+    } else if (typeof Duktape !== 'undefined') {
+        Duktape.fin(this, function(node) {
+            call_python('releaseHandle', node.handle);
+        });
+    }
+}
+
+// the browser freed these elements, so their listeners can never fire again
+function __forgetHandles(handles) {
+    for (var i = 0; i < handles.length; i++) {
+        delete LISTENERS[handles[i]];
+    }
 }
 
 Node.prototype.getAttribute = function(attr) {
@@ -48,12 +69,59 @@ Node.prototype.dispatchEvent = function(evt) {
     return evt.do_default;
 }
 
+// called by the browser for every event, so that it doesn't have to send over new code each time
+function __dispatchEvent(handle, type) {
+    var do_default = new Node(handle).dispatchEvent(new Event(type));
+    __drainMicrotasks();
+    return do_default;
+}
+
 Object.defineProperty(Node.prototype, 'innerHTML', {
     set: function(s) {
         call_python('innerHTML_set', this.handle, s.toString());
     }
 });
 
+// queues up dom reads and writes so they can be sent to the browser in one call instead of one call each.
+// every queueing method returns the index its result will have in the array returned by flush()
+function DomBatch() {
+    this.ops = [];
+}
+
+document.batch = function() {
+    return new DomBatch();
+}
+
+DomBatch.prototype.querySelectorAll = function(s) {
+    this.ops.push(['querySelectorAll', s]);
+    return this.ops.length - 1;
+}
+
+DomBatch.prototype.getAttribute = function(node, attr) {
+    this.ops.push(['getAttribute', node.handle, attr]);
+    return this.ops.length - 1;
+}
+
+DomBatch.prototype.setInnerHTML = function(node, s) {
+    this.ops.push(['innerHTML_set', node.handle, s.toString()]);
+    return this.ops.length - 1;
+}
+
+DomBatch.prototype.flush = function() {
+    var ops = this.ops;
+    this.ops = [];
+    if (ops.length == 0) return [];
+    var results = call_python('batch', ops);
+    for (var i = 0; i < ops.length; i++) {
+        if (ops[i][0] == 'querySelectorAll') {
+            results[i] = results[i].map(function(h) {
+                return new Node(h);
+            });
+        }
+    }
+    return results;
+}
+
 function Event(type) {
     this.type = type
     this.do_default = true;
@@ -63,15 +131,113 @@ Event.prototype.preventDefault = function() {
     this.do_default = false;
 }
 
+// async requests waiting for a response, by handle
+XHR_REQUESTS = {};
+XHR_COUNT = 0;
+
 function XMLHttpRequest() {}
 
 XMLHttpRequest.prototype.open = function(method, url, is_async) {
-    if (is_async) throw Error("Asynchronous XHR is not supported");
+    this.is_async = !!is_async;
     this.method = method;
     this.url = url;
 }
 
 XMLHttpRequest.prototype.send = function(body) {
-    this.responseText = call_python("XMLHttpRequest_send",
-        this.method, this.url, body);
-}
\ No newline at end of file
+    if (this.is_async) {
+        var handle = XHR_COUNT++;
+        XHR_REQUESTS[handle] = this;
+        call_python("XMLHttpRequest_send",
+            this.method, this.url, body, true, handle);
+    } else {
+        this.responseText = call_python("XMLHttpRequest_send",
+            this.method, this.url, body, false, -1);
+    }
+}
+
+// called by the browser once an async request has finished. body is null if it failed
+function __runXHROnload(body, handle) {
+    var xhr = XHR_REQUESTS[handle];
+    delete XHR_REQUESTS[handle];
+    if (body === null) {
+        if (xhr.onerror) xhr.onerror(new Event('error'));
+    } else {
+        xhr.responseText = body;
+        if (xhr.onload) xhr.onload(new Event('load'));
+    }
+    __drainMicrotasks();
+}
+
+// microtasks run as soon as the current task (script, event, timer...) is done
+MICROTASKS = [];
+
+queueMicrotask = function(callback) {
+    MICROTASKS.push(callback);
+}
+
+function __drainMicrotasks() {
+    while (MICROTASKS.length > 0) {
+        MICROTASKS.shift()();
+    }
+}
+
+// runs a page's script in the global scope, like a <script> tag would, and then its microtasks
+function __runScript(code) {
+    var result = (0, eval)(code);
+    __drainMicrotasks();
+    return result;
+}
+
+// timers by handle. the browser keeps track of when they are due and calls __runTimer
+TIMERS = {};
+TIMER_COUNT = 0;
+
+function setTimeout(callback, delay) {
+    var handle = ++TIMER_COUNT;
+    TIMERS[handle] = {callback: callback, delay: -1};
+    call_python('setTimeout', handle, delay || 0);
+    return handle;
+}
+
+function setInterval(callback, delay) {
+    var handle = ++TIMER_COUNT;
+    TIMERS[handle] = {callback: callback, delay: delay || 0};
+    call_python('setTimeout', handle, delay || 0);
+    return handle;
+}
+
+// no need to tell the browser, __runTimer just won't find the timer
+function clearTimeout(handle) {
+    delete TIMERS[handle];
+}
+
+clearInterval = clearTimeout;
+
+// returns the delay until the timer should run again, or -1 if it is done
+function __runTimer(handle) {
+    var timer = TIMERS[handle];
+    if (!timer) return -1;
+    if (timer.delay < 0) delete TIMERS[handle];
+    timer.callback();
+    __drainMicrotasks();
+    return TIMERS[handle] ? timer.delay : -1;
+}
+
+// animation frame callbacks run once per frame, right before the browser renders
+RAF_LISTENERS = [];
+
+function requestAnimationFrame(callback) {
+    RAF_LISTENERS.push(callback);
+    if (RAF_LISTENERS.length == 1) {
+        call_python('requestAnimationFrame');
+    }
+}
+
+function __runRAFHandlers(time) {
+    var handlers = RAF_LISTENERS;
+    RAF_LISTENERS = [];
+    for (var i = 0; i < handlers.length; i++) {
+        handlers[i](time);
+    }
+    __drainMicrotasks();
+}
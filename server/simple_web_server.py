@@ -1,22 +1,139 @@
+import concurrent.futures
+import select
+import selectors
 import socket
+import sys
+import threading
+import time
 import urllib.parse
 import random
 import html
 
+# connections are handled on a pool of this many threads. a client that is slow to send its request ties up a
+# worker until it finishes or REQUEST_TIMEOUT_SEC runs out, so it takes WORKERS slow clients to hold up everyone
+# else, and then only for that long. set with --workers N
+WORKERS = 8
+REQUEST_TIMEOUT_SEC = 2
+
 # store info about each user/client
 SESSIONS = {}
 
+# keep-alive connections that don't send a request for this long are closed. they wait in IdleConnections, not
+# in a worker, so this only limits how many sockets are left open
+IDLE_TIMEOUT_SEC = 5
+
+# how long a worker waits for a kept-alive connection's next request before handing it to IdleConnections. clients
+# that send requests back to back skip the trip through the selector thread
+KEEP_ALIVE_LINGER_SEC = 0.005
+
+# connection reuse numbers, see record_connection
+CONNECTION_STATS = {'connections': 0, 'requests': 0, 'reused': 0}
+STATS_LOCK = threading.Lock()
+REUSE_LOG_EVERY = 100
+
+# SESSIONS, ENTRIES and the sessions themselves are shared by every worker thread, so requests only look at
+# or change them while holding this
+STATE_LOCK = threading.Lock()
+
 # hardcoded for convenience
 LOGINS = {
     'crashoverride': '0cool',
     'cerealkiller': 'emmanuel'
 }
 
-def handle_connection(conx):
+# a client's socket, the buffered reader its requests are read from, and how many requests it has sent so far
+class Connection:
+    def __init__(self, conx):
+        self.conx = conx
+        self.conx.settimeout(REQUEST_TIMEOUT_SEC)
+        self.req = conx.makefile('b')
+        self.requests = 0
+
+    # whether the next request starts arriving within timeout, or already has (pipelined, say). the socket is
+    # watched with select rather than given a timeout, since a timeout would break req for good
+    def has_data(self, timeout):
+        self.conx.setblocking(False)
+        try:
+            if self.req.peek(1):
+                return True
+        finally:
+            self.conx.settimeout(REQUEST_TIMEOUT_SEC)
+        readable, writable, errors = select.select([self.conx], [], [], timeout)
+        return bool(readable)
+
+    def close(self):
+        if self.requests:
+            record_connection(self.requests)
+        self.req.close()
+        self.conx.close()
+
+# keep-alive connections waiting for their next request sit here instead of in a worker. one thread watches them
+# all with a selector, hands each one back to the pool once its next request starts arriving, and closes the ones
+# that have been idle for IDLE_TIMEOUT_SEC (checked about once a second)
+class IdleConnections:
+    def __init__(self, pool):
+        self.pool = pool
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.added = [] # connections from workers that the selector thread hasn't picked up yet
+        # workers write to this to wake the selector thread up when they add a connection
+        self.wakeup, self.wakeup_sender = socket.socketpair()
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # called from workers
+    def add(self, connection):
+        with self.lock:
+            self.added.append(connection)
+        self.wakeup_sender.send(b'\0')
+
+    def run(self):
+        while True:
+            events = self.selector.select(timeout=1)
+            now = time.monotonic()
+            for key, mask in events:
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(4096)
+                    with self.lock:
+                        added, self.added = self.added, []
+                    for connection in added:
+                        self.selector.register(connection.conx, selectors.EVENT_READ, (connection, now))
+                else:
+                    connection = key.data[0]
+                    self.selector.unregister(connection.conx)
+                    self.pool.submit(handle_connection_safely, connection, self)
+            for key in list(self.selector.get_map().values()):
+                if key.fileobj is not self.wakeup and now - key.data[1] > IDLE_TIMEOUT_SEC:
+                    self.selector.unregister(key.fileobj)
+                    key.data[0].close()
+
+# answer requests on a connection until the client closes it or asks for it to be closed, or until it has no
+# request ready, in which case it waits for one in idle. pipelined requests are answered straight away
+def handle_connection(connection, idle):
+    try:
+        while True:
+            keep_alive = handle_request(connection.conx, connection.req)
+            if keep_alive is None:
+                break # client closed the connection
+            connection.requests += 1
+            if not keep_alive:
+                break
+            if not connection.has_data(KEEP_ALIVE_LINGER_SEC):
+                idle.add(connection)
+                return
+    except socket.timeout:
+        pass # too slow sending a request
+    connection.close()
+
+# answers one request, returns whether the connection should stay open for another, or None if the client
+# closed it before sending one
+def handle_request(conx, req):
     # read the request line
-    req = conx.makefile('b')
     reqline = req.readline().decode('utf8')
+    if not reqline:
+        return None
     method, url, version = reqline.split(' ', 2)
+    version = version.strip()
     assert method in ['GET', 'POST']
 
     # read and store headers until a blank line is reached
@@ -28,33 +145,60 @@ def handle_connection(conx):
         header, value = line.split(':', 1)
         headers[header.casefold()] = value.strip()
 
+    # http/1.1 connections stay open unless the client says otherwise, http/1.0 ones only if it asks
+    connection = headers.get('connection', '').casefold()
+    if version == 'HTTP/1.1':
+        keep_alive = connection != 'close'
+    else:
+        keep_alive = connection == 'keep-alive'
+    response_version = 'HTTP/1.1' if version == 'HTTP/1.1' else 'HTTP/1.0'
+
     # grab cookie if it is available
     if 'cookie' in headers:
         token = headers['cookie'][len('token='):]
     else:
         token = str(random.random())[2:]
 
-    # read the body if it exists
-    if 'content-length' in headers:
-        length = int(headers['content-length'])
-        body = req.read(length).decode('utf8')
+    # read the body if it exists. it's framed by content-length alone, anything after it is the next request.
+    # chunked bodies can't be framed that way, so those connections end after the error
+    if 'transfer-encoding' in headers:
+        status, body, keep_alive = '501 Not Implemented', not_implemented('Transfer-Encoding'), False
     else:
-        body = None
+        if 'content-length' in headers:
+            length = int(headers['content-length'])
+            body = req.read(length).decode('utf8')
+        else:
+            body = None
 
-    session = SESSIONS.setdefault(token, {})
-    status, body = do_request(session, method, url, headers, body)
+        with STATE_LOCK:
+            session = SESSIONS.setdefault(token, {})
+            status, body = do_request(session, method, url, headers, body)
 
     # send the page back to the browser
-    response = 'HTTP/1.0 {}\r\n'.format(status)
+    response = '{} {}\r\n'.format(response_version, status)
     response += 'Content-Length: {}\r\n'.format(len(body.encode('utf8')))
+    response += 'Connection: {}\r\n'.format('keep-alive' if keep_alive else 'close')
     if 'cookie' not in headers:
         template = 'Set-Cookie: token={}\r\n'
         response += template.format(token)
     csp = "default-src http://localhost:8000"
     response += "Content-Security-Policy: {}\r\n".format(csp)
     response += '\r\n' + body
-    conx.send(response.encode('utf8'))
-    conx.close()
+    conx.sendall(response.encode('utf8'))
+    return keep_alive
+
+# how many requests connections carry, printed every REUSE_LOG_EVERY connections
+def record_connection(requests):
+    with STATS_LOCK:
+        CONNECTION_STATS['connections'] += 1
+        CONNECTION_STATS['requests'] += requests
+        if requests > 1:
+            CONNECTION_STATS['reused'] += 1
+        if CONNECTION_STATS['connections'] % REUSE_LOG_EVERY == 0:
+            connections, total, reused = (CONNECTION_STATS['connections'], CONNECTION_STATS['requests'],
+                                          CONNECTION_STATS['reused'])
+            print('{} connections, {} requests: {:.1f} requests per connection, {:.0%} of connections reused'.format(
+                connections, total, total / connections, reused / connections))
 
 # output html to show the entries
 def show_comments(session):
@@ -144,6 +288,11 @@ def do_login(session, params):
         out += '<h1>Invalid password for {}</h1>'.format(username)
         return '401 Unauthorized', out
 
+def not_implemented(feature):
+    out = '<!doctype html>'
+    out += '<h1>{} is not supported</h1>'.format(feature)
+    return out
+
 def not_found(url, method):
     out = '<!doctype html>'
     out += '<h1>{} {} not found!</h1>'.format(method, url)
@@ -154,16 +303,33 @@ ENTRIES = [
     ('HACK THE PLANET!!!', 'crashoverride'),
 ]
 
-s = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+# a client that sends a bad request only loses its own connection
+def handle_connection_safely(connection, idle):
+    try:
+        handle_connection(connection, idle)
+    except Exception as e:
+        print('Error handling connection:', e)
+        connection.close()
+
+def serve(port, workers):
+    s = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+
+    # prevent os from blocking temporarily this port if a crash occurs
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-# prevent os from blocking temporarily this port if a crash occurs
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # wait for computer to connect
+    s.bind(('', port)) # anyone can connect to the server on this port
+    s.listen()
 
-# wait for computer to connect
-s.bind(('', 8000)) # anyone can connect to the server on port 8000
-s.listen()
+    # accept connections here and hand each one to a worker
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        idle = IdleConnections(pool)
+        while True:
+            conx, addr = s.accept()
+            pool.submit(handle_connection_safely, Connection(conx), idle)
 
-# runs once per connection
-while True:
-    conx, addr = s.accept()
-    handle_connection(conx)
\ No newline at end of file
+if __name__ == '__main__':
+    workers = WORKERS
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    serve(8000, workers)
\ No newline at end of file
@@ -1,19 +1,59 @@
+import array
+import bisect
+import collections
+import heapq
+import itertools
+import os
 import socket
-import ssl
-import tkinter
-import tkinter.font
+import sys
+import threading
+import time
 import urllib.parse
-import dukpy
+import weakref
+
+# tkinter, dukpy, ssl, multiprocessing and concurrent.futures are slow to import, so they're imported where
+# they're used. that way tools that only need the parser or layout don't pay for the gui and the js engine
 
 WIDTH, HEIGHT = 800, 600
 H_STEP, V_STEP = 13, 18
 SCROLL_STEP = 100
 
+# canvas items are kept around this far past the edges of the viewport, so
+# scrolling by a step only has to create the items that newly come into view
+SCROLL_BUFFER = HEIGHT
+
+# display list commands taller than this are culled separately so they don't widen every viewport search
+TALL_COMMAND_HEIGHT = HEIGHT
+
+# rendering and drawing happen at most once per frame
+FRAME_BUDGET_MS = 16
+
+# tabs that haven't been looked at for this long are discarded down to their url, scroll position and form state
+IDLE_DISCARD_SEC = 30 * 60
+LIFECYCLE_CHECK_MS = 60 * 1000
+
+# file that Browser.memory_usage gets appended to every MEMORY_LOG_MS, or None. set with --memory-log <file>
+MEMORY_LOG = None
+MEMORY_LOG_MS = 10 * 1000
+
+# run each tab's loading, scripts, style, layout and paint in a process of its own, so a busy or crashed page
+# can't hold up the window. the browser process only draws the display lists the tabs send back. set
+# with --process-per-tab
+PROCESS_PER_TAB = False
+
 # inputs are usually a fixed width
 INPUT_WIDTH_PX = 200
 
 FONTS = {} # for caching
 
+# measure text with HeadlessFont instead of tk fonts, so the pipeline can run without a display (e.g. in
+# benchmarks). layouts come out close to, but not the same as, the real thing
+HEADLESS_FONTS = False
+
+# runtime.js and browser.css live next to this file, and are read the first time they're needed
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSETS = {} # file name -> contents
+
 # since these properties are inheirited, they need default vals in case they are not specified by children
 INHERITED_PROPERTIES = {
     'font-size': '16px',
@@ -24,14 +64,85 @@ INHERITED_PROPERTIES = {
 
 COOKIE_JAR = {}
 
+# when set, Url.request records to or replays from this NetworkArchive. set with use_network_archive,
+# or --record <file> / --replay <file>
+NETWORK_ARCHIVE = None
+REPLAY_LATENCY_MS = 50 # per request, for --replay
+REPLAY_BANDWIDTH = 1000 * 1000 # bytes per second, for --replay
+
+# how much of a page is read at a time, so the preload scanner can look at it before the rest arrives
+RESPONSE_CHUNK_SIZE = 4096
+
 def get_font(size, weight, style):
     key = (size, weight, style)
     if key not in FONTS:
+        if HEADLESS_FONTS:
+            FONTS[key] = (HeadlessFont(size, weight, style), None)
+            return FONTS[key][0]
+        import tkinter.font
         font = tkinter.font.Font(size=size, weight=weight,slant=style)
         label = tkinter.Label(font=font)
         FONTS[key] = (font, label)
     return FONTS[key][0]
 
+# the font a node's text is drawn in
+def node_font(node):
+    weight = node.style['font-weight']
+    style = node.style['font-style']
+    if style == 'normal':
+        style = 'roman'
+    size = int(float(node.style['font-size'][:-2]) * .75) # converts css pixels to tk points
+    return get_font(size, weight, style)
+
+# measuring text goes all the way to tk, so every word is only measured once per font. fonts are cached forever
+# in FONTS, so their ids are stable keys. the widths are shared by every page, so each font only keeps
+# WORD_WIDTHS_PER_FONT of them
+WORD_WIDTHS = {} # id(font) -> {word: width}
+WORD_WIDTHS_PER_FONT = 20000
+FONT_METRICS = {} # id(font) -> (ascent, descent, linespace)
+
+def word_widths(font, words):
+    widths = WORD_WIDTHS.get(id(font))
+    if widths is None:
+        widths = WORD_WIDTHS[id(font)] = {}
+    new_words = set(words).difference(widths)
+    if len(widths) + len(new_words) > WORD_WIDTHS_PER_FONT:
+        # forget the older half. dicts keep insertion order, so those are the words that were measured longest ago
+        for word in list(itertools.islice(widths, len(widths) // 2)):
+            del widths[word]
+        new_words = set(words).difference(widths)
+    for word in new_words:
+        widths[word] = font.measure(word)
+    return [widths[word] for word in words]
+
+def font_metrics(font):
+    metrics = FONT_METRICS.get(id(font))
+    if metrics is None:
+        metrics = FONT_METRICS[id(font)] = (font.metrics('ascent'), font.metrics('descent'),
+                                            font.metrics('linespace'))
+    return metrics
+
+# stands in for tkinter.font.Font when HEADLESS_FONTS is set. every character gets the same width
+class HeadlessFont:
+    def __init__(self, size, weight, style):
+        self.size = size
+        self.weight = weight
+        self.style = style
+        px = size * 4 / 3 # tk font sizes are in points
+        self.char_width = round(px * (0.6 if weight == 'bold' else 0.55))
+        self.ascent = round(px * 0.9)
+        self.descent = round(px * 0.25)
+
+    def measure(self, text):
+        return self.char_width * len(text)
+
+    def metrics(self, option):
+        if option == 'ascent':
+            return self.ascent
+        elif option == 'descent':
+            return self.descent
+        return self.ascent + self.descent # linespace
+
 class ElementList:
     BLOCK_ELEMENTS = [
         'html', 'body', 'article', 'section', 'nav', 'aside',
@@ -53,16 +164,100 @@ class ElementList:
     ]
 
 # js constants
-RUNTIME_JS = open('runtime.js').read()
-EVENT_DISPATCH_JS = 'new Node(dukpy.handle).dispatchEvent(new Event(dukpy.type))'
+EVENT_DISPATCH_JS = '__dispatchEvent(dukpy.handle, dukpy.type)' # the function itself is defined once in runtime.js
+
+# how many set up js contexts to keep ready for pages that haven't been loaded yet
+JS_POOL_SIZE = 2
+
+# scripts, event handlers and timers that run longer than this many seconds get stopped. set to None to turn
+# the watchdog off. stopping a script needs the interpreter to live in its own process, so that costs a little
+SCRIPT_TIMEOUT_SEC = None
+
+# async XMLHttpRequests run on a pool of background threads, with a cap on how many hit one origin at once
+REQUEST_WORKERS = 6
+REQUESTS_PER_ORIGIN = 2
+
+# selectors are immutable once parsed, so querySelectorAll only parses each selector string once
+SELECTOR_CACHE = {}
+
+# tracing, in chrome's trace event format, so it can be opened in chrome://tracing or https://ui.perfetto.dev.
+# off unless the browser is started with --trace <file> or this environment variable is set to a file name
+TRACE_ENV = 'WEB_BROWSER_TRACE'
+TRACER = None # set by start_tracing
+
+# writes a complete ("X") event for every span as soon as it ends. the trace format allows the closing ] to be
+# missing, which means a trace is still readable if the process is killed
+class Tracer:
+    def __init__(self, path, process_name):
+        import json
+        self.dumps = json.dumps
+        self.path = path
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.file = open(path, 'w', buffering=1)
+        self.file.write('[\n')
+        self.write({'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': process_name}})
+
+    def span(self, name, category, args):
+        return Span(self, name, category, args)
+
+    # span arguments can be anything with a str(), so callers don't pay for formatting them when tracing is off
+    def write(self, event):
+        line = self.dumps(event, default=str) + ',\n'
+        with self.lock:
+            self.file.write(line)
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        self.tracer.write({'name': self.name, 'cat': self.category, 'ph': 'X', 'ts': self.start / 1000,
+                           'dur': (end - self.start) / 1000, 'pid': self.tracer.pid,
+                           'tid': threading.get_ident(), 'args': self.args})
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_SPAN = NullSpan() # what trace hands out when tracing is off, so a span costs next to nothing
+
+# with trace('layout'): ... records how long the block took. spans nest by time, per thread
+def trace(name, category='pipeline', **args):
+    if TRACER is None:
+        return NULL_SPAN
+    return TRACER.span(name, category, args)
+
+def start_tracing(path, process_name='browser'):
+    global TRACER
+    TRACER = Tracer(path, process_name)
+
+# the environment variable works for anything that imports the browser, not just the window. it's taken out of the
+# environment so that renderer processes, which trace to files of their own, don't start over the browser's file
+if os.environ.get(TRACE_ENV):
+    start_tracing(os.environ.pop(TRACE_ENV))
 
 class Browser:
     def __init__(self):
+        import tkinter
         self.tabs = []
         self.active_tab = None
         self.window = tkinter.Tk()
         self.canvas = tkinter.Canvas(self.window, width=WIDTH, height=HEIGHT, bg='white')
         self.canvas.pack()
+        self.content = CanvasLayer(self.canvas, 'content')
+        self.chrome_layer = CanvasLayer(self.canvas, 'chrome')
         self.window.bind('<Down>', self.handle_down) # self.scrolldown is an event handler
         self.window.bind('<Button-1>', self.handle_click) # left-click action
         self.chrome = Chrome(self)
@@ -71,9 +266,25 @@ class Browser:
 
         self.focus = None
 
+        # get js contexts ready before the first page needs one. with PROCESS_PER_TAB the renderers do this instead
+        if not PROCESS_PER_TAB:
+            JS_POOL.refill()
+        self.window.after(LIFECYCLE_CHECK_MS, self.check_idle_tabs)
+        if MEMORY_LOG:
+            self.window.after(MEMORY_LOG_MS, self.log_memory)
+
+        # frame scheduling. events only mark what needs redoing, and run_frame does it once per frame
+        self.needs_draw = False
+        self.frame_timer = None # id of the pending window.after call for run_frame, if any
+        self.frame_due = 0 # when that call will happen
+        self.last_frame_start = 0
+        self.frame_time_ms = 0 # how long the last frame took
+        self.frame_count = 0
+        self.dropped_frames = 0 # frames missed because a frame ran over FRAME_BUDGET_MS
+
     def handle_down(self, e):
         self.active_tab.scrolldown()
-        self.draw()
+        self.set_needs_draw()
 
     def handle_click(self, e):
         if e.y < self.chrome.bottom:
@@ -86,7 +297,7 @@ class Browser:
 
             tab_y = e.y - self.chrome.bottom
             self.active_tab.click(e.x, tab_y)
-        self.draw()
+        self.set_needs_draw()
 
     def handle_key(self, e):
         if len(e.char) == 0:
@@ -95,28 +306,135 @@ class Browser:
             return
         # send the keypress to the address bar or input (or nothing if neither) have focus
         if self.chrome.keypress(e.char):
-            self.draw()
+            self.set_needs_draw()
         elif self.focus == 'content':
             self.active_tab.keypress(e.char)
-            self.draw()
+            self.set_needs_draw()
 
     def handle_enter(self, e):
         self.chrome.enter()
-        self.draw()
+        self.set_needs_draw()
+
+    def set_needs_draw(self):
+        self.needs_draw = True
+        self.schedule_frame()
+
+    # arrange for run_frame to happen at the start of the next frame (or delay_ms from now, if that's later),
+    # unless it is already going to happen by then
+    def schedule_frame(self, delay_ms=0):
+        now = time.perf_counter()
+        next_frame = self.last_frame_start + FRAME_BUDGET_MS / 1000
+        due = max(now + delay_ms / 1000, next_frame)
+        if self.frame_timer is not None:
+            if self.frame_due <= due:
+                return
+            self.window.after_cancel(self.frame_timer)
+        self.frame_due = due
+        self.frame_timer = self.window.after(max(0, int((due - now) * 1000)), self.run_frame)
+
+    def run_frame(self):
+        with trace('frame'):
+            self.frame_timer = None
+            start = time.perf_counter()
+            self.last_frame_start = start
+
+            # tasks that background work, timers and so on queued up for the main thread
+            for tab in self.tabs:
+                tab.task_runner.run()
+
+            # animation frame callbacks come right before rendering so that their changes make it into this frame
+            self.active_tab.run_animation_frame()
+
+            if self.active_tab.needs_render:
+                self.active_tab.render()
+                self.needs_draw = True
+            if self.needs_draw:
+                self.draw()
+                self.needs_draw = False
+
+            # keep checking for results while any tab is waiting on something, otherwise wake up for the next timer
+            if any(tab.task_runner.pending() for tab in self.tabs):
+                self.schedule_frame()
+            else:
+                delays = [tab.task_runner.next_timer_delay() for tab in self.tabs]
+                delays = [delay for delay in delays if delay is not None]
+                if delays:
+                    self.schedule_frame(min(delays))
 
-    def draw(self):
-        self.canvas.delete('all')
-        self.active_tab.draw(self.canvas, self.chrome.bottom)
+            self.frame_time_ms = (time.perf_counter() - start) * 1000
+            self.frame_count += 1
+            if self.frame_time_ms > FRAME_BUDGET_MS:
+                self.dropped_frames += int(self.frame_time_ms // FRAME_BUDGET_MS)
 
-        for cmd in self.chrome.paint():
-            cmd.execute(0, self.canvas)
+    def draw(self):
+        with trace('draw'):
+            self.active_tab.draw(self.content, self.chrome.bottom)
+
+            # new page items go on top of everything, so the chrome has to be put back over them
+            if self.content.stats['created']:
+                self.canvas.tag_raise('chrome')
+            chrome, diff = self.chrome.display_list()
+            self.chrome_layer.draw(chrome, 0, 0, self.chrome.bottom, diff)
+
+    # how many canvas items the last frame created, updated and deleted, plus frame timing
+    def frame_stats(self):
+        stats = dict(self.content.stats)
+        stats['chrome'] = dict(self.chrome_layer.stats)
+        stats['frame_time_ms'] = self.frame_time_ms
+        stats['frames'] = self.frame_count
+        stats['dropped_frames'] = self.dropped_frames
+        return stats
 
     def new_tab(self, url):
-        new_tab = Tab(HEIGHT - self.chrome.bottom)
+        if PROCESS_PER_TAB:
+            new_tab = RemoteTab(self, HEIGHT - self.chrome.bottom)
+        else:
+            new_tab = Tab(self, HEIGHT - self.chrome.bottom)
         new_tab.load(url)
-        self.active_tab = new_tab
         self.tabs.append(new_tab)
-        self.draw()
+        self.activate_tab(new_tab)
+
+    # the tab being switched away from drops its layout and display list straight away
+    def activate_tab(self, tab):
+        if tab is self.active_tab:
+            return
+        if self.active_tab:
+            self.active_tab.suspend()
+        self.active_tab = tab
+        tab.activate()
+        self.set_needs_draw()
+
+    def check_idle_tabs(self):
+        now = time.monotonic()
+        for tab in self.tabs:
+            if (tab is not self.active_tab and not tab.discarded and tab.can_discard() and
+                    now - tab.last_active > IDLE_DISCARD_SEC):
+                tab.discard()
+        self.window.after(LIFECYCLE_CHECK_MS, self.check_idle_tabs)
+
+    # per tab numbers from Tab.memory_usage, plus the caches every tab shares
+    def memory_usage(self):
+        return {
+            'tabs': [tab.memory_usage() for tab in self.tabs],
+            'cookie_jar': {'count': len(COOKIE_JAR), 'bytes': sys.getsizeof(COOKIE_JAR) + sum(
+                sys.getsizeof(cookie) + dict_bytes(params) for cookie, params in COOKIE_JAR.values())},
+            'fonts': {'count': len(FONTS), 'bytes': dict_bytes(FONTS)},
+            'word_widths': {'count': sum(len(widths) for widths in WORD_WIDTHS.values()),
+                            'bytes': dict_bytes(WORD_WIDTHS)},
+            'selector_cache': {'count': len(SELECTOR_CACHE), 'bytes': dict_bytes(SELECTOR_CACHE)},
+            'assets': {'count': len(ASSETS), 'bytes': dict_bytes(ASSETS)},
+            'canvas_items': {'count': len(self.content.items), 'bytes': dict_bytes(self.content.items)},
+            'traced': traced_allocations(),
+        }
+
+    # appends memory_usage to MEMORY_LOG as a line of json every MEMORY_LOG_MS
+    def log_memory(self):
+        import json
+        usage = self.memory_usage()
+        usage['time'] = time.time()
+        with open(MEMORY_LOG, 'a') as f:
+            f.write(json.dumps(usage) + '\n')
+        self.window.after(MEMORY_LOG_MS, self.log_memory)
 
 # this class will allow the user to navigate thru tabs
 class Chrome:
@@ -133,6 +451,11 @@ class Chrome:
         self.focus = None
         self.address_bar = ''
 
+        # the last paint, kept until something it depends on changes. see display_list
+        self.painted = DisplayList()
+        self.painted_key = None
+        self.painted_diff = None
+
         # new tab button
         plus_width = self.font.measure('+') + 2 * self.padding
         self.newtab_rect = Rect(
@@ -161,72 +484,87 @@ class Chrome:
             WIDTH - self.padding,
             self.urlbar_bottom - self.padding)
 
+        self.tab_width = self.font.measure('Tab X') + 2 * self.padding
+
     # since the number of tabs can change, just compute their bounds on the go
     def tab_rect(self, i):
         tabs_start = self.newtab_rect.right + self.padding
-        tab_width = self.font.measure('Tab X') + 2 * self.padding
         return Rect(
-            tabs_start + tab_width * i, self.tabbar_top,
-            tabs_start + tab_width * (i + 1), self.tabbar_bottom)
+            tabs_start + self.tab_width * i, self.tabbar_top,
+            tabs_start + self.tab_width * (i + 1), self.tabbar_bottom)
+
+    # everything paint looks at. the chrome only needs repainting when one of these changes
+    def paint_key(self):
+        tab = self.browser.active_tab
+        active = self.browser.tabs.index(tab) if tab in self.browser.tabs else None
+        return len(self.browser.tabs), active, self.focus, self.address_bar, str(tab.url) if tab else None
+
+    # the chrome's display list and how it differs from the one drawn before, repainted only if needed
+    def display_list(self):
+        key = self.paint_key()
+        if key != self.painted_key:
+            old = self.painted
+            self.painted = self.paint()
+            self.painted_key = key
+            self.painted_diff = DisplayListDiff(old, self.painted)
+        return self.painted, self.painted_diff
 
     def paint(self):
-        cmds = []
+        cmds = DisplayList()
 
         # guarantee that the browser chrome is drawn on top of page contents
-        cmds.append(DrawRect(
+        cmds.rect(
             Rect(0, 0, WIDTH, self.bottom),
-            'white'))
-        cmds.append(DrawLine(
+            'white')
+        cmds.line(
             0, self.bottom, WIDTH,
-            self.bottom, 'black', 1))
+            self.bottom, 'black', 1)
 
         # draw the new tab button
-        cmds.append(DrawOutline(self.newtab_rect, 'black', 1))
-        cmds.append(DrawText(
+        cmds.outline(self.newtab_rect, 'black', 1)
+        cmds.text(
             self.newtab_rect.left + self.padding,
             self.newtab_rect.top,
-            '+', self.font, 'black'))
+            '+', self.font, 'black')
 
         # draw the tabs themselves
         for i, tab in enumerate(self.browser.tabs):
             bounds = self.tab_rect(i)
-            cmds.append(DrawLine(
+            cmds.line(
                 bounds.left, 0, bounds.left, bounds.bottom,
-                'black', 1))
-            cmds.append(DrawLine(
+                'black', 1)
+            cmds.line(
                 bounds.right, 0, bounds.right, bounds.bottom,
-                'black', 1))
-            cmds.append(DrawText(
+                'black', 1)
+            cmds.text(
                 bounds.left + self.padding, bounds.top + self.padding,
-                'Tab {}'.format(i), self.font, 'black'))
+                'Tab {}'.format(i), self.font, 'black')
 
             # make the active tab more prominent
             if tab == self.browser.active_tab:
-                cmds.append(DrawLine(
+                cmds.line(
                     0, bounds.bottom, bounds.left, bounds.bottom,
-                    'black', 1))
-                cmds.append(DrawLine(
+                    'black', 1)
+                cmds.line(
                     bounds.right, bounds.bottom, WIDTH, bounds.bottom,
-                    'black', 1))
+                    'black', 1)
 
-        cmds.append(DrawOutline(self.back_rect, 'black', 1))
-        cmds.append(DrawText(self.back_rect.left + self.padding, self.back_rect.top,'<', self.font, 'black'))
+        cmds.outline(self.back_rect, 'black', 1)
+        cmds.text(self.back_rect.left + self.padding, self.back_rect.top,'<', self.font, 'black')
 
-        cmds.append(DrawOutline(self.address_rect, 'black', 1))
-        url = str(self.browser.active_tab.url)
-        cmds.append(DrawText(self.address_rect.left + self.padding, self.address_rect.top, url, self.font, 'black'))
+        cmds.outline(self.address_rect, 'black', 1)
 
         # draw the currently typed text
         if self.focus == 'address bar':
-            cmds.append(DrawText(self.address_rect.left + self.padding, self.address_rect.top, self.address_bar, self.font, 'black'))
+            cmds.text(self.address_rect.left + self.padding, self.address_rect.top, self.address_bar, self.font, 'black')
             # add in a cursor
             w = self.font.measure(self.address_bar)
-            cmds.append(DrawLine(self.address_rect.left + self.padding + w, self.address_rect.top, self.address_rect.left +
-                                 self.padding + w,self.address_rect.bottom, 'red', 1))
+            cmds.line(self.address_rect.left + self.padding + w, self.address_rect.top, self.address_rect.left +
+                      self.padding + w,self.address_rect.bottom, 'red', 1)
         # draw the url
         else:
             url = str(self.browser.active_tab.url)
-            cmds.append(DrawText(self.address_rect.left + self.padding, self.address_rect.top, url, self.font, 'black'))
+            cmds.text(self.address_rect.left + self.padding, self.address_rect.top, url, self.font, 'black')
 
         return cmds
 
@@ -251,7 +589,7 @@ class Chrome:
         else:
             for i, tab in enumerate(self.browser.tabs):
                 if self.tab_rect(i).contains_point(x, y):
-                    self.browser.active_tab = tab
+                    self.browser.activate_tab(tab)
                     break
 
     def keypress(self, char):
@@ -269,26 +607,44 @@ class Chrome:
         self.focus = None
 
 class Tab:
-    def __init__(self, tab_height):
+    def __init__(self, browser, tab_height):
+        self.browser = browser # None when the tab is used without a window
         self.scroll = 0
         self.url = None # page's url
+        self.payload = None # form data the page was posted with, if it was
         self.tab_height = tab_height
         self.history = []
 
         # load default styles
-        self.rules = DEFAULT_STYLE_SHEET.copy()
+        self.rules = default_style_sheet().copy()
         self.nodes = []
+        self.dom_index = DomIndex()
         self.focus = None # this will remember which text input we clicked on
+        self.display_list = DisplayList()
+        self.display_list_diff = None # how the display list changed in the last render
+        self.needs_render = False
+        self.needs_full_render = False # style and layout everything, not just dirty_subtrees
+        self.dirty_subtrees = [] # elements whose children were replaced since the last render
+        self.document = None
+        self.needs_animation_frame = False # the page has requestAnimationFrame callbacks waiting
+        self.task_runner = TaskRunner(self)
         self.js = None
         self.allowed_origins = None
 
+        # lifecycle
+        self.last_active = time.monotonic() # when the tab last stopped being the active one
+        self.discarded = False
+        self.form_state = [] # values of the inputs on a discarded page, in document order
+
     def scrolldown(self):
+        self.render_if_needed()
         max_y = max(self.document.height + 2 * V_STEP - self.tab_height, 0)
         self.scroll = min(self.scroll + SCROLL_STEP, max_y)
 
     def click(self, x, y):
         y += self.scroll # we want relative y position, so add the scroll height to y
         self.focus = None # clear focus
+        self.render_if_needed() # hit testing needs an up to date layout
 
         # find out what the user clicked on
         objs = [obj for obj in tree_to_list(self.document, [])
@@ -323,9 +679,9 @@ class Tab:
                 elt.attributes['value'] = ''
                 self.focus = elt
                 elt.is_focused = True
-                return self.render()
+                return self.set_needs_render()
             elt = elt.parent
-        self.render()
+        self.set_needs_render()
 
     # find all input elements, encode them, send post request
     def submit_form(self, elt):
@@ -353,83 +709,164 @@ class Tab:
         self.load(url, body)
 
     def load(self, url, payload=None):
-        # make request, receive response - duh
-        headers, body = url.request(self.url, payload)
-        self.history.append(url)
-        self.url = url # current url
-        self.nodes = HtmlParser(body).parse()
-        self.js = JsContext(self)
-        self.allowed_origins = None
+        with trace('load', url=url):
+            if NETWORK_ARCHIVE and not NETWORK_ARCHIVE.replaying:
+                NETWORK_ARCHIVE.record_navigation(url)
 
-        if "content-security-policy" in headers:
-            csp = headers["content-security-policy"].split()
-            if len(csp) > 0 and csp[0] == "default-src":
-                self.allowed_origins = []
-                for origin in csp[1:]:
-                    self.allowed_origins.append(Url(origin).origin())
-
-        # grab links to js files
-        scripts = [node.attributes['src'] for node
-                   in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == 'script'
-                   and 'src' in node.attributes]
-
-        # run all the scripts
-        for script in scripts:
-            script_url = url.resolve(script)
-            if not self.allowed_request(script_url):
-                print("Blocked script", script, "due to CSP")
-                continue
-            try:
-                header, body = script_url.request(url)
-            except:
-                continue
-
-            self.js.run(script, body)
-
-        # grab links to external stylesheets
-        links = [node.attributes['href']
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == 'link'
-                 and node.attributes.get('rel') == 'stylesheet'
-                 and 'href' in node.attributes]
-
-        # add rules from linked stylesheets to rules list
-        for link in links:
-            style_url = url.resolve(link)
-            if not self.allowed_request(style_url):
-                print("Blocked script", link, "due to CSP")
-                continue
+            # make request, receive response - duh. scripts and stylesheets start downloading as soon as they show up
+            scanner = PreloadScanner(url)
             try:
-                header, body = style_url.request(url)
-            except:
-                continue
-            self.rules.extend(CssParser(body).parse())
-
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-
-        self.render()
+                headers, body = url.request(self.url, payload, scanner.feed)
+                self.history.append(url)
+                self.url = url # current url
+                self.payload = payload
+                self.dom_index = DomIndex()
+                with trace('parse HTML'):
+                    self.nodes = HtmlParser(body, self.dom_index).parse()
+                if self.js:
+                    self.js.close()
+                self.js = JS_POOL.acquire(self)
+                self.allowed_origins = csp_allowed_origins(headers)
+
+                # grab links to js files
+                scripts = [node.attributes['src'] for node in self.dom_index.elements('script')
+                           if 'src' in node.attributes]
+
+                # run all the scripts
+                for script in scripts:
+                    script_url = url.resolve(script)
+                    if not self.allowed_request(script_url):
+                        print("Blocked script", script, "due to CSP")
+                        continue
+                    try:
+                        header, body = self.request_subresource(script_url)
+                    except:
+                        continue
+
+                    self.js.run(script, '__runScript(dukpy.source)', source=body)
+
+                # grab links to external stylesheets
+                links = [node.attributes['href'] for node in self.dom_index.elements('link')
+                         if node.attributes.get('rel') == 'stylesheet'
+                         and 'href' in node.attributes]
+
+                # add rules from linked stylesheets to rules list
+                for link in links:
+                    style_url = url.resolve(link)
+                    if not self.allowed_request(style_url):
+                        print("Blocked script", link, "due to CSP")
+                        continue
+                    try:
+                        header, body = self.request_subresource(style_url)
+                    except:
+                        continue
+                    with trace('parse CSS', url=style_url):
+                        self.rules.extend(CssParser(body).parse())
+            finally:
+                # anything the scanner fetched that the page turned out not to use, or that it never got to
+                # because loading failed. left in REQUEST_POOL, a later load of the same url would get it
+                for preloaded in scanner.preloaded:
+                    REQUEST_POOL.take(preloaded)
+
+            with trace('style'):
+                style(self.nodes, sorted(self.rules, key=cascade_priority))
+
+            self.set_needs_render()
+
+    # use the preload scanner's response if it already asked for url
+    def request_subresource(self, url):
+        future = REQUEST_POOL.take(url)
+        if future:
+            return future.result()
+        return url.request(self.url)
+
+    # rendering is deferred to the next frame so that several changes in a row only cost one render
+    def set_needs_render(self):
+        self.needs_render = True
+        self.needs_full_render = True
+        if self.browser:
+            self.browser.schedule_frame()
+
+    # only elt's children changed, so only they need styling and only elt's block needs layout
+    def set_needs_subtree_render(self, elt):
+        if self.document is None:
+            return self.set_needs_render()
+        self.needs_render = True
+        self.dirty_subtrees.append(elt)
+        if self.browser:
+            self.browser.schedule_frame()
+
+    def set_needs_animation_frame(self):
+        self.needs_animation_frame = True
+        if self.browser:
+            self.browser.schedule_frame()
+
+    def run_animation_frame(self):
+        if self.needs_animation_frame:
+            self.needs_animation_frame = False
+            self.js.run_animation_frame()
+
+    def render_if_needed(self):
+        if self.needs_render:
+            self.render()
 
     # separate styling, layout, and paint from loading
     def render(self):
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
-
-    def draw(self, canvas, offset):
-        canvas.delete('all')
-
-        # don't draw things that are not visible
-        for cmd in self.display_list:
-            if cmd.rect.top > self.scroll + self.tab_height:
-                continue
-            if cmd.rect.bottom < self.scroll:
-                continue
-            cmd.execute(self.scroll - offset, canvas)
+        self.needs_render = False
+        rules = sorted(self.rules, key=cascade_priority)
+        if self.needs_full_render or self.document is None:
+            with trace('style'):
+                style(self.nodes, rules)
+            with trace('layout'):
+                self.document = DocumentLayout(self.nodes)
+                self.document.layout()
+        else:
+            for elt in dict.fromkeys(self.dirty_subtrees):
+                with trace('render subtree', tag=elt.tag):
+                    self.render_subtree(elt, rules)
+        self.needs_full_render = False
+        self.dirty_subtrees = []
+
+        old_display_list = self.display_list
+        self.display_list = DisplayList()
+        with trace('paint'):
+            paint_tree(self.document, self.display_list)
+        with trace('diff display list'):
+            self.display_list_diff = DisplayListDiff(old_display_list, self.display_list)
+
+    def render_subtree(self, elt, rules):
+        block = self.containing_block(elt)
+        if block is None:
+            return # elt was removed from the document since
+        for child in elt.children:
+            style(child, rules)
+        relayout(block)
+
+    # the innermost BlockLayout that elt's contents are laid out in, found by walking down the
+    # layout tree along elt's ancestors
+    def containing_block(self, elt):
+        path = []
+        node = elt
+        while node:
+            path.append(node)
+            node = node.parent
+        path.reverse()
+        if path[0] is not self.nodes:
+            return None
+
+        block = self.document.children[0]
+        for node in path[1:]:
+            for child in block.children:
+                if isinstance(child, BlockLayout) and child.node is node:
+                    block = child
+                    break
+            else:
+                break
+        return block
+
+    def draw(self, layer, offset):
+        layer.draw(self.display_list, self.scroll - offset,
+                   self.scroll, self.scroll + self.tab_height, self.display_list_diff)
 
     def go_back(self):
         if len(self.history) > 1:
@@ -443,12 +880,293 @@ class Tab:
             if self.js.dispatch_event('keydown', self.focus):
                 return
             self.focus.attributes['value'] += char
-            self.render()
+            self.set_needs_render()
+
+    # how long the page's scripts and handlers took, see JsContext.profile_report
+    def script_profile(self):
+        return self.js.profile_report() if self.js else []
+
+    # called when another tab becomes active. layout and paint can be redone from the dom when it comes back
+    def suspend(self):
+        self.last_active = time.monotonic()
+        self.document = None
+        self.display_list = DisplayList()
+        self.display_list_diff = None
+        self.needs_render = True
+        self.needs_full_render = True
+
+    # loading the result of a form submission again would submit the form again, so those pages are kept
+    def can_discard(self):
+        return self.payload is None
+
+    # throw away everything but what's needed to load the page again and put it back the way it was
+    def discard(self):
+        self.form_state = [node.attributes.get('value', '') for node in self.dom_index.elements('input')]
+        if self.js:
+            self.js.close()
+        self.js = None
+        self.nodes = None
+        self.dom_index = DomIndex()
+        self.focus = None
+        self.rules = default_style_sheet().copy()
+        self.task_runner = TaskRunner(self)
+        self.discarded = True
+
+    def activate(self):
+        if self.discarded:
+            self.restore()
+        else:
+            self.set_needs_render()
+
+    def restore(self):
+        scroll, form_state = self.scroll, self.form_state
+        self.load(self.history.pop()) # load puts it back on the history
+        inputs = self.dom_index.elements('input')
+        if len(inputs) == len(form_state):
+            for node, value in zip(inputs, form_state):
+                node.attributes['value'] = value
+        self.scroll = scroll
+        self.form_state = []
+        self.discarded = False
+
+    # what the tab is holding on to, as {'count': objects, 'bytes': shallow size} per subsystem. bytes only
+    # count the objects themselves and the dicts and strings they own, not what they share with others
+    def memory_usage(self):
+        nodes = tree_to_list(self.nodes, []) if self.nodes else []
+        layout_objects = tree_to_list(self.document, []) if self.document else []
+        dom_bytes = style_bytes = styles = 0
+        for node in nodes:
+            dom_bytes += object_bytes(node)
+            if isinstance(node, Element):
+                dom_bytes += dict_bytes(node.attributes)
+            else:
+                dom_bytes += sys.getsizeof(node.text)
+            if hasattr(node, 'style'):
+                styles += 1
+                style_bytes += dict_bytes(node.style)
+        if self.discarded:
+            state = 'discarded'
+        elif self.browser and self.browser.active_tab is self:
+            state = 'active'
+        else:
+            state = 'suspended'
+        return {
+            'url': str(self.url),
+            'state': state,
+            'dom': {'count': len(nodes), 'bytes': dom_bytes},
+            'style': {'count': styles, 'bytes': style_bytes},
+            'rules': {'count': len(self.rules), 'bytes': sum(dict_bytes(body) for selector, body in self.rules)},
+            'layout': {'count': len(layout_objects), 'bytes': sum(object_bytes(obj) for obj in layout_objects)},
+            'display_list': {'count': len(self.display_list), 'bytes': self.display_list.nbytes()},
+            'js_handles': {'count': len(self.js.handle_to_node) if self.js else 0,
+                           'bytes': self.js.handle_table_bytes() if self.js else 0},
+        }
 
     def allowed_request(self, url):
         return self.allowed_origins is None or \
             url.origin() in self.allowed_origins
 
+# stands in for a Tab whose pipeline runs in a renderer process (see PROCESS_PER_TAB). input is forwarded to the
+# renderer, and each display list it sends back is drawn like a local tab's would be. scrolling happens here
+class RemoteTab:
+    def __init__(self, browser, tab_height):
+        self.browser = browser
+        self.scroll = 0
+        self.url = None
+        self.posted = False # whether the page came from a form submission, as of the last display list
+        self.tab_height = tab_height
+        self.display_list = DisplayList()
+        self.display_list_diff = None
+        self.document_height = 0 # height of the page as of the last display list
+        self.needs_render = False # the renderer renders by itself
+        self.last_active = time.monotonic()
+        self.discarded = False
+        self.usage = {} # last memory_usage the renderer reported
+        self.task_runner = RendererProcess(self)
+
+    def load(self, url, payload=None):
+        self.url = url
+        self.task_runner.send('load', url, payload)
+
+    def click(self, x, y):
+        self.task_runner.send('click', x, y, self.scroll)
+
+    def keypress(self, char):
+        self.task_runner.send('keypress', char)
+
+    def go_back(self):
+        self.task_runner.send('go_back')
+
+    def scrolldown(self):
+        max_y = max(self.document_height + 2 * V_STEP - self.tab_height, 0)
+        self.scroll = min(self.scroll + SCROLL_STEP, max_y)
+
+    def run_animation_frame(self):
+        pass
+
+    def render(self):
+        pass
+
+    def render_if_needed(self):
+        pass
+
+    def draw(self, layer, offset):
+        layer.draw(self.display_list, self.scroll - offset,
+                   self.scroll, self.scroll + self.tab_height, self.display_list_diff)
+
+    # called by RendererProcess with each message from the renderer
+    def receive(self, message):
+        if message[0] == 'frame':
+            display_list, matched, changed, self.document_height, self.url, self.posted = message[1:]
+            self.display_list_diff = DisplayListDiff(self.display_list, display_list, matched, changed)
+            self.display_list = display_list
+            if self.browser.active_tab is self:
+                self.browser.set_needs_draw()
+        elif message[0] == 'memory':
+            self.usage = message[1]
+
+    def suspend(self):
+        self.last_active = time.monotonic()
+        self.display_list = DisplayList()
+        self.display_list_diff = None
+        self.task_runner.send('suspend')
+
+    def can_discard(self):
+        return not self.posted
+
+    def discard(self):
+        self.discarded = True
+        self.task_runner.send('discard')
+
+    def activate(self):
+        self.discarded = False
+        self.task_runner.send('activate')
+
+    # the renderer's numbers are from the last time it was asked, since asking can't wait for the answer
+    def memory_usage(self):
+        self.task_runner.send('memory')
+        usage = dict(self.usage)
+        if self.discarded:
+            usage['state'] = 'discarded'
+        elif self.browser.active_tab is self:
+            usage['state'] = 'active'
+        else:
+            usage['state'] = 'suspended'
+        usage['renderer_pid'] = self.task_runner.process.pid
+        usage['display_list'] = {'count': len(self.display_list), 'bytes': self.display_list.nbytes()}
+        return usage
+
+# the browser's end of a renderer process. it takes the place of a TaskRunner in the frame loop: running it hands
+# whatever the renderer has sent to the RemoteTab
+class RendererProcess:
+    def __init__(self, tab):
+        self.tab = tab
+        import multiprocessing
+        import tkinter
+        # renderers are spawned rather than forked, since forking copies the state of every other thread
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        trace_path = TRACER.path if TRACER else None
+        archive = NETWORK_ARCHIVE.settings() if NETWORK_ARCHIVE else None
+        self.process = context.Process(target=run_renderer, args=(child_conn, tab.tab_height, trace_path, archive),
+                                       daemon=True)
+        self.process.start()
+        self.crashed = False
+
+        # get woken up when the renderer sends something. where tk can't do that, the frame loop polls
+        self.tk = tab.browser.window.tk
+        self.polling = not hasattr(self.tk, 'createfilehandler')
+        if not self.polling:
+            self.tk.createfilehandler(self.conn.fileno(), tkinter.READABLE, lambda fd, mask: self.run())
+
+    def send(self, *message):
+        if not self.crashed:
+            self.conn.send(message)
+
+    def pending(self):
+        return self.polling and not self.crashed
+
+    def next_timer_delay(self):
+        return None # the renderer keeps its own timers
+
+    def run(self):
+        try:
+            while not self.crashed and self.conn.poll():
+                self.tab.receive(self.conn.recv())
+        except (EOFError, OSError):
+            print('Renderer for', self.tab.url, 'crashed')
+            self.crashed = True
+            if not self.polling:
+                self.tk.deletefilehandler(self.conn.fileno())
+
+# the renderer process side of RemoteTab: a Tab without a browser, running its own frame loop and sending back
+# the display list every time it renders
+def run_renderer(conn, tab_height, trace_path, archive):
+    global NETWORK_ARCHIVE
+    import tkinter
+    if trace_path:
+        # each renderer traces to a file of its own next to the browser's
+        start_tracing('{}.renderer-{}'.format(trace_path, os.getpid()), 'renderer')
+    if archive:
+        # renderers record into the browser's archive, rather than starting it over like use_network_archive
+        NETWORK_ARCHIVE = NetworkArchive(*archive)
+    tkinter.Tk().withdraw() # fonts can't be measured without a tk root, even one that's never shown
+    JS_POOL.refill()
+    tab = Tab(None, tab_height)
+    active = True # suspended renderers keep running tasks and timers, but don't render
+    # the display list the browser has, which frames are diffed against. handlers like Tab.click can render more
+    # than once between frames, so it isn't necessarily the one the tab's own diff starts from
+    last_sent = DisplayList()
+    while True:
+        if tab.task_runner.pending() or (active and tab.needs_animation_frame):
+            timeout = FRAME_BUDGET_MS / 1000
+        else:
+            delay = tab.task_runner.next_timer_delay()
+            timeout = None if delay is None else delay / 1000
+
+        try:
+            while conn.poll(timeout):
+                timeout = 0
+                message = conn.recv()
+                try:
+                    if message[0] == 'load':
+                        tab.load(*message[1:])
+                    elif message[0] == 'click':
+                        x, y, tab.scroll = message[1:]
+                        tab.click(x, y)
+                    elif message[0] == 'keypress':
+                        tab.keypress(message[1])
+                    elif message[0] == 'go_back':
+                        tab.go_back()
+                    elif message[0] == 'suspend':
+                        active = False
+                        last_sent = DisplayList() # RemoteTab.suspend empties its display list
+                        tab.suspend()
+                    elif message[0] == 'discard':
+                        tab.discard()
+                    elif message[0] == 'activate':
+                        active = True
+                        tab.activate()
+                    elif message[0] == 'memory':
+                        conn.send(('memory', tab.memory_usage()))
+                except Exception as e:
+                    print('Renderer failed to handle', message[0], e)
+        except EOFError:
+            return # the browser went away
+
+        tab.task_runner.run()
+        if active:
+            tab.run_animation_frame()
+            if tab.needs_render:
+                tab.render()
+            if tab.display_list is not last_sent:
+                diff = tab.display_list_diff
+                if diff is None or diff.old is not last_sent:
+                    diff = DisplayListDiff(last_sent, tab.display_list)
+                conn.send(('frame', tab.display_list, diff.matched, diff.changed, tab.document.height, tab.url,
+                           tab.payload is not None))
+                last_sent = tab.display_list
+
 class Url:
     def __init__(self, url):
         self.scheme, url = url.split('://', 1)
@@ -468,25 +1186,35 @@ class Url:
             self.host, port = self.host.split(':', 1)
             self.port = int(port)
 
-    def request(self, referrer, payload=None):
+    # on_chunk, if given, is called with the response headers and each piece of the body as it arrives
+    def request(self, referrer, payload=None, on_chunk=None):
+        with trace('request', 'network', url=self):
+            method = 'POST' if payload else 'GET'
+            if NETWORK_ARCHIVE and NETWORK_ARCHIVE.replaying:
+                response_headers, content = NETWORK_ARCHIVE.replay(method, self, payload)
+                if on_chunk:
+                    on_chunk(response_headers, content)
+            else:
+                response_headers, content = self.fetch(method, referrer, payload, on_chunk)
+                if NETWORK_ARCHIVE:
+                    NETWORK_ARCHIVE.record(method, self, payload, response_headers, content)
+            self.save_cookie(response_headers)
+            return response_headers, content
+
+    # send the request over the network and read the whole response
+    def fetch(self, method, referrer, payload, on_chunk=None):
         s = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
         s.connect((self.host, self.port))
         if self.scheme == 'https':
+            import ssl
             ctx = ssl.create_default_context()
             s = ctx.wrap_socket(s, server_hostname=self.host)
 
-        method = 'POST' if payload else 'GET'
-
         request = '{} {} HTTP/1.0\r\n'.format(method, self.path)
         request += 'Host: {}\r\n'.format(self.host)
-        if self.host in COOKIE_JAR:
-            cookie, params = COOKIE_JAR[self.host]
-            allow_cookie = True
-            if referrer and params.get('samesite', 'none') == 'lax':
-                if method != 'GET':
-                    allow_cookie = self.host == referrer.host
-            if allow_cookie:
-                request += 'Cookie: {}\r\n'.format(cookie)
+        cookie = self.cookie(method, referrer)
+        if cookie:
+            request += 'Cookie: {}\r\n'.format(cookie)
         if payload:
             length = len(payload.encode('utf8'))
             request += 'Content-Length: {}\r\n'.format(length)
@@ -511,6 +1239,32 @@ class Url:
         assert 'transfer-encoding' not in response_headers
         assert 'content-encoding' not in response_headers
 
+        if on_chunk is None:
+            content = response.read()
+        else:
+            chunks = []
+            while True:
+                chunk = response.read(RESPONSE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                on_chunk(response_headers, chunk)
+                chunks.append(chunk)
+            content = ''.join(chunks)
+        s.close()
+
+        return response_headers, content
+
+    # the cookie to send with a request to this url, if there is one and samesite allows it
+    def cookie(self, method, referrer):
+        if self.host not in COOKIE_JAR:
+            return None
+        cookie, params = COOKIE_JAR[self.host]
+        if referrer and params.get('samesite', 'none') == 'lax':
+            if method != 'GET' and self.host != referrer.host:
+                return None
+        return cookie
+
+    def save_cookie(self, response_headers):
         if 'set-cookie' in response_headers:
             cookie = response_headers['set-cookie']
             params = {}
@@ -524,11 +1278,6 @@ class Url:
                     params[param.strip().casefold()] = value.casefold()
             COOKIE_JAR[self.host] = (cookie, params)
 
-        content = response.read()
-        s.close()
-
-        return response_headers, content
-
     # convert different kinds of urls to full urls
     def resolve(self, url):
         if '://' in url: return Url(url)
@@ -560,6 +1309,129 @@ class Url:
     def origin(self):
         return self.scheme + '://' + self.host + ':' + str(self.port)
 
+# an archive of responses, so that page loads can be benchmarked without a server or the internet. recording
+# appends every request Url.request makes and its response to a file of json lines. replaying serves the recorded
+# responses instead of going to the network, after waiting latency_ms plus however long the body would take at
+# bandwidth bytes per second (None for no limit). a request that was recorded more than once gets its responses
+# in the order they were recorded, then the last one from then on
+class NetworkArchive:
+    def __init__(self, path, replaying, latency_ms=0, bandwidth=None):
+        import json
+        self.json = json
+        self.path = path
+        self.replaying = replaying
+        self.latency_ms = latency_ms
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.responses = {} # (method, url, payload) -> recorded (headers, body)s, oldest first
+        self.navigations = [] # urls of the pages that were loaded, in order
+        if replaying:
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if 'navigation' in entry:
+                        self.navigations.append(entry['navigation'])
+                        continue
+                    key = (entry['method'], entry['url'], entry['payload'])
+                    self.responses.setdefault(key, []).append((entry['headers'], entry['body']))
+
+    # so renderer processes can open the same archive
+    def settings(self):
+        return self.path, self.replaying, self.latency_ms, self.bandwidth
+
+    def record(self, method, url, payload, headers, body):
+        line = self.json.dumps({'method': method, 'url': str(url), 'payload': payload,
+                                'headers': headers, 'body': body})
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+    # responses are written as they arrive, so a page's subresources can come before the page itself. the url that
+    # was loaded is written down separately, before any of them
+    def record_navigation(self, url):
+        line = self.json.dumps({'navigation': str(url)})
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+    def replay(self, method, url, payload):
+        key = (method, str(url), payload)
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                raise ConnectionError('{} {} is not in {}'.format(method, url, self.path))
+            headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+        delay = self.latency_ms / 1000
+        if self.bandwidth:
+            delay += len(body.encode('utf8')) / self.bandwidth
+        time.sleep(delay)
+        return dict(headers), body
+
+def use_network_archive(path, replaying, latency_ms=0, bandwidth=None):
+    global NETWORK_ARCHIVE
+    if not replaying:
+        open(path, 'w').close() # start a new recording
+    NETWORK_ARCHIVE = NetworkArchive(path, replaying, latency_ms, bandwidth)
+
+# origins a content-security-policy header allows subresources from, or None if anything goes
+def csp_allowed_origins(headers):
+    if "content-security-policy" in headers:
+        csp = headers["content-security-policy"].split()
+        if len(csp) > 0 and csp[0] == "default-src":
+            return [Url(origin).origin() for origin in csp[1:]]
+    return None
+
+# looks through a page's html as it downloads for scripts and stylesheets, and preloads them on REQUEST_POOL so
+# they're on their way by the time Tab.load gets to them. it only looks at tags, so it can be fooled into
+# fetching something the page doesn't use (a tag inside a comment, say); Tab.load drops those afterwards
+class PreloadScanner:
+    def __init__(self, url):
+        self.url = url
+        self.allowed_origins = None
+        self.seen_headers = False
+        self.buffer = '' # the start of a tag that hasn't finished arriving
+        self.preloaded = [] # urls handed to REQUEST_POOL.preload
+        self.get_attributes = HtmlParser('').get_attributes # attributes are read the same way the parser does
+
+    def feed(self, headers, chunk):
+        if not self.seen_headers:
+            self.seen_headers = True
+            self.allowed_origins = csp_allowed_origins(headers) # nothing is fetched that csp would block
+        text = self.buffer + chunk
+        start = 0
+        while True:
+            open_at = text.find('<', start)
+            if open_at == -1:
+                start = len(text)
+                break
+            close_at = text.find('>', open_at)
+            if close_at == -1:
+                start = open_at
+                break
+            self.scan_tag(text[open_at + 1:close_at])
+            start = close_at + 1
+        self.buffer = text[start:]
+
+    def scan_tag(self, text):
+        head = text[:6].casefold()
+        if head != 'script' and not head.startswith('link'):
+            return
+        tag, attributes = self.get_attributes(text)
+        if tag == 'script' and 'src' in attributes:
+            self.preload(attributes['src'])
+        elif tag == 'link' and attributes.get('rel') == 'stylesheet' and 'href' in attributes:
+            self.preload(attributes['href'])
+
+    def preload(self, link):
+        try:
+            url = self.url.resolve(link)
+        except (AssertionError, ValueError):
+            return # Url only does http and https
+        if self.allowed_origins is not None and url.origin() not in self.allowed_origins:
+            return
+        REQUEST_POOL.preload(url, self.url)
+        self.preloaded.append(url)
+
 class Text:
     def __init__(self, text, parent):
         self.text = text
@@ -577,14 +1449,59 @@ class Element:
         self.parent = parent
         self.attributes = attributes
         self.is_focused = False
+        self.position = () # where it is in document order, see DomIndex
 
     def __repr__(self):
         return '<' + self.tag + '>'
 
+# elements of a document grouped by tag, so that queries don't have to walk the whole tree.
+# HtmlParser adds elements as it creates them and innerHTML_set swaps subtrees in and out
+#
+# each element gets a position tuple that sorts in document order. parsed elements are numbered as they're
+# created. elements inserted later get their parent's position plus a number of their own, which sorts after the
+# parent and before anything after the parent's subtree, so nothing that's already indexed has to be renumbered
+class DomIndex:
+    def __init__(self):
+        self.by_tag = {} # tag -> dict of elements used as an ordered set
+        self.unordered = set() # tags whose elements may no longer be in document order
+        self.next_position = 0
+
+    def add(self, node, parent_position=()):
+        if isinstance(node, Element):
+            node.position = parent_position + (self.next_position,)
+            self.next_position += 1
+            self.by_tag.setdefault(node.tag, {})[node] = None
+
+    # elements added after parsing are appended, so their tags need sorting again before use
+    def add_tree(self, node):
+        parent_position = node.parent.position
+        for node in tree_to_list(node, []):
+            if isinstance(node, Element):
+                self.add(node, parent_position)
+                self.unordered.add(node.tag)
+
+    def remove_tree(self, node):
+        for node in tree_to_list(node, []):
+            if isinstance(node, Element) and node.tag in self.by_tag:
+                self.by_tag[node.tag].pop(node, None)
+
+    # elements with the given tag in document order. after insertions the bucket is a few already sorted runs,
+    # which sorted merges in close to linear time
+    def elements(self, tag):
+        nodes = self.by_tag.get(tag)
+        if not nodes:
+            return []
+        if tag in self.unordered:
+            self.by_tag[tag] = nodes = dict.fromkeys(sorted(nodes, key=lambda node: node.position))
+            self.unordered.discard(tag)
+        return list(nodes)
+
 class HtmlParser:
-    def __init__(self, body):
+    def __init__(self, body, index=None):
         self.body = body
         self.unfinished = []
+        self.index = index # DomIndex to record new elements in, if any
+        self.fragment = False
 
     def add_text(self, text):
         if text.isspace():
@@ -613,10 +1530,14 @@ class HtmlParser:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
             parent.children.append(node)
+            if self.index is not None:
+                self.index.add(node)
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
             self.unfinished.append(node)
+            if self.index is not None:
+                self.index.add(node)
 
     def get_attributes(self, text):
         parts = text.split()
@@ -661,7 +1582,17 @@ class HtmlParser:
             self.add_text(text)
         return self.finish()
 
+    # parse html that goes inside an existing element (like for innerHTML). the new nodes are added to parent's
+    # children, without any html, head or body tags around them
+    def parse_fragment(self, parent):
+        self.fragment = True
+        self.unfinished = [parent]
+        self.parse()
+        return parent.children
+
     def implicit_tags(self, tag):
+        if self.fragment:
+            return
         while True:
             open_tags = [node.tag for node in self.unfinished]
             if open_tags == [] and tag != 'html':
@@ -687,8 +1618,6 @@ class BlockLayout:
         self.previous = previous
         self.children = []
 
-        self.display_list = [] # idk if i still need this or nah
-
         self.x = None
         self.y = None
         self.width = None
@@ -697,9 +1626,7 @@ class BlockLayout:
 
     def recurse(self, node):
         if isinstance(node, Text):
-            for word in node.text.split():
-                # noinspection PyTypeChecker
-                self.word(node, word)
+            self.text(node)
         else:
             if node.tag == 'br':
                 self.new_line()
@@ -709,24 +1636,40 @@ class BlockLayout:
                 for child in node.children:
                     self.recurse(child)
 
-    def word(self, node, word):
-        # get the property values of for the font
-        weight = node.style['font-weight']
-        style = node.style['font-style']
-        if style == 'normal':
-            style = 'roman'
-        size = int(float(node.style['font-size'][:-2]) * .75) # converts css pixels to tk points
-        font = get_font(size, weight, style)
-        color = node.style['color']
-
-        w = font.measure(word)
-        if self.cursor_x + w > self.width:
-            self.new_line()
-
-        line = self.children[-1]
-        previous_word = line.children[-1] if line.children else None
-        text = TextLayout(node, word, line, previous_word)
-        line.children.append(text)
+    # lays out all of a text node's words in one go. ends holds where each word's space ends if the words were
+    # laid end to end, so the words that still fit on the current line can be found by bisecting it
+    def text(self, node):
+        words = node.text.split()
+        if not words:
+            return
+        font = node_font(node)
+        height = font_metrics(font)[2]
+        space = word_widths(font, [' '])[0]
+        widths = word_widths(font, words)
+        ends = list(itertools.accumulate(width + space for width in widths))
+        rights = [end - space for end in ends] # where each word itself ends
+
+        start = 0 # first word not placed yet
+        offset = 0 # where that word starts in ends
+        while start < len(words):
+            line = self.children[-1]
+            count = bisect.bisect_right(rights, offset + self.width - self.cursor_x, start) - start
+            if count == 0:
+                if line.children:
+                    self.new_line()
+                    continue
+                count = 1 # too wide for any line, so it gets one to itself
+
+            previous = line.children[-1] if line.children else None
+            x = self.x + self.cursor_x - offset
+            for i in range(start, start + count):
+                text = TextLayout(node, words[i], line, previous, font, x + (ends[i - 1] if i else 0), widths[i],
+                                  height)
+                line.children.append(text)
+                previous = text
+            start += count
+            self.cursor_x += ends[start - 1] - offset
+            offset = ends[start - 1]
 
     def new_line(self):
         self.cursor_x = 0
@@ -786,13 +1729,8 @@ class BlockLayout:
         input = InputLayout(node, line, previous_word)
         line.children.append(input)
 
-        weight = node.style['font-weight']
-        style = node.style['font-style']
-        if style == 'normal': style = 'roman'
-        size = int(float(node.style['font-size'][:-2]) * .75)
-        font = get_font(size, weight, style)
-
-        self.cursor_x += w + font.measure(' ')
+        font = node_font(node)
+        self.cursor_x += w + word_widths(font, [' '])[0]
 
     '''
     <input> and <button> creates a BlockLayout which then creates an InputLayout inside it which paints the background
@@ -803,17 +1741,10 @@ class BlockLayout:
         return isinstance(self.node, Text) or \
             (self.node.tag != 'input' and self.node.tag != 'button')
 
-    def paint(self):
-        cmds = []
-        if self.layout_mode() == 'inline':
-            for x, y, word, font, color in self.display_list:
-                cmds.append(DrawText(x, y, word, font, color))
-
+    def paint(self, display_list):
         bgcolor = self.node.style.get('background-color', 'transparent')
         if bgcolor != 'transparent':
-            rect = DrawRect(self.self_rect(), bgcolor)
-            cmds.append(rect)
-        return cmds
+            display_list.rect(self.self_rect(), bgcolor)
 
     def self_rect(self):
         return Rect(self.x, self.y, self.x + self.width, self.y + self.height)
@@ -833,8 +1764,8 @@ class DocumentLayout:
         child.layout()
         self.height = child.height
 
-    def paint(self):
-        return []
+    def paint(self, display_list):
+        pass
 
     def should_paint(self):
         return True
@@ -867,56 +1798,43 @@ class LineLayout:
             self.height = 0
             return
 
-        max_ascent = max([word.font.metrics('ascent')
-                          for word in self.children])
+        # lines are usually in one or two fonts, so look each one's metrics up once
+        fonts = {id(word.font): word.font for word in self.children}
+        metrics = {key: font_metrics(font) for key, font in fonts.items()}
+        max_ascent = max([ascent for ascent, descent, linespace in metrics.values()])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline - word.font.metrics('ascent')
-        max_descent = max([word.font.metrics('descent')
-                           for word in self.children])
+            word.y = baseline - metrics[id(word.font)][0]
+        max_descent = max([descent for ascent, descent, linespace in metrics.values()])
 
         self.height = 1.25 * (max_ascent + max_descent)
 
-    def paint(self):
-        return []
+    def paint(self, display_list):
+        pass
 
     def should_paint(self):
         return True
 
+# the font, x position and size are worked out by BlockLayout.text for the whole text node at once
 class TextLayout:
-    def __init__(self, node, word, parent, previous):
+    def __init__(self, node, word, parent, previous, font, x, width, height):
         self.node = node
         self.word = word
         self.children = []
         self.parent = parent
         self.previous = previous
-        self.x = None
+        self.x = x
         self.y = None
-        self.width = None
-        self.height = None
-        self.font = None
+        self.width = width
+        self.height = height
+        self.font = font
 
     def layout(self):
-        weight = self.node.style['font-weight']
-        style = self.node.style['font-style']
-        if style == 'normal':
-            style = 'roman'
-        size = int(float(self.node.style['font-size'][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+        pass
 
-        self.width = self.font.measure(self.word)
-
-        if self.previous:
-            space = self.previous.font.measure(' ')
-            self.x = self.previous.x + space + self.previous.width
-        else:
-            self.x = self.parent.x
-
-        self.height = self.font.metrics('linespace')
-
-    def paint(self):
+    def paint(self, display_list):
         color = self.node.style['color']
-        return [DrawText(self.x, self.y, self.word, self.font, color)]
+        display_list.text(self.x, self.y, self.word, self.font, color, self.width, self.height)
 
     def should_paint(self):
         return True
@@ -935,29 +1853,21 @@ class InputLayout:
         self.font = None
 
     def layout(self):
-        weight = self.node.style['font-weight']
-        style = self.node.style['font-style']
-        if style == 'normal':
-            style = 'roman'
-        size = int(float(self.node.style['font-size'][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+        self.font = node_font(self.node)
 
         if self.previous:
-            space = self.previous.font.measure(' ')
+            space = word_widths(self.previous.font, [' '])[0]
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics('linespace')
-
+        self.height = font_metrics(self.font)[2]
 
-    def paint(self):
-        cmds = []
+    def paint(self, display_list):
         bgcolor = self.node.style.get('background-color',
                                       'transparent')
         if bgcolor != 'transparent':
-            rect = DrawRect(self.self_rect(), bgcolor)
-            cmds.append(rect)
+            display_list.rect(self.self_rect(), bgcolor)
 
         if self.node.tag == 'input':
             text = self.node.attributes.get('value', '')
@@ -969,14 +1879,14 @@ class InputLayout:
                 print('Ignoring HTML contents inside button')
                 text = ''
         color = self.node.style['color']
-        cmds.append(DrawText(self.x, self.y, text, self.font, color))
+        text_width = self.font.measure(text)
+        display_list.text(self.x, self.y, text, self.font, color, text_width, self.height)
 
         # draw cursor if input is focused
         if self.node.is_focused:
-            cx = self.x + self.font.measure(text)
-            cmds.append(DrawLine(
-                cx, self.y, cx, self.y + self.height, 'black', 1))
-        return cmds
+            cx = self.x + text_width
+            display_list.line(
+                cx, self.y, cx, self.y + self.height, 'black', 1)
 
     def should_paint(self):
         return True
@@ -994,46 +1904,284 @@ class Rect:
     def contains_point(self, x, y):
         return x >= self.left and x < self.right and y >= self.top and y < self.bottom
 
-class DrawText:
-    def __init__(self, x1, y1, text, font, color):
-        self.text = text
-        self.font = font
-        self.bottom = y1 + font.metrics('linespace')
-        self.color = color
-        self.rect = Rect(x1, y1, x1 + font.measure(text), y1 + font.metrics('linespace'))
-
-    def execute(self, scroll, canvas):
-        canvas.create_text(self.rect.left, self.rect.top - scroll, text=self.text, font=self.font, anchor='nw',
-                           fill=self.color)
-
-class DrawRect:
-    def __init__(self, rect, color):
-        self.color = color
-        self.rect = rect
-
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(self.rect.left, self.rect.top - scroll, self.rect.right, self.rect.bottom - scroll,
-            width=0, fill=self.color)
-
-class DrawOutline:
-    def __init__(self, rect, color, thickness):
-        self.rect = rect
-        self.color = color
-        self.thickness = thickness
-
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(self.rect.left, self.rect.top - scroll, self.rect.right, self.rect.bottom - scroll,
-            width=self.thickness, outline=self.color)
-
-class DrawLine:
-    def __init__(self, x1, y1, x2, y2, color, thickness):
-        self.rect = Rect(x1, y1, x2, y2)
-        self.color = color
-        self.thickness = thickness
-
-    def execute(self, scroll, canvas):
-        canvas.create_line(self.rect.left, self.rect.top - scroll, self.rect.right, self.rect.bottom - scroll,
-            fill=self.color, width=self.thickness)
+# display list opcodes
+DRAW_TEXT, DRAW_RECT, DRAW_OUTLINE, DRAW_LINE = range(4)
+
+# the commands of a page, stored as columns of flat arrays (one entry per command, in paint order) rather than
+# one object per command. strings, fonts and colors repeat a lot, so the columns only hold indices into side tables
+class DisplayList:
+    def __init__(self):
+        self.ops = array.array('B')
+        self.lefts = array.array('f')
+        self.tops = array.array('f')
+        self.rights = array.array('f')
+        self.bottoms = array.array('f')
+        self.strings = array.array('L')
+        self.fonts = array.array('H')
+        self.colors = array.array('H')
+        self.thicknesses = array.array('B')
+        # id of the node that painted each command, only used to match commands up between renders
+        self.owners = array.array('Q')
+
+        self.string_table = ['']
+        self.string_ids = {'': 0}
+        self.font_table = [None]
+        self.font_ids = {id(None): 0} # fonts are cached forever in FONTS, so their ids are stable
+        self.color_table = []
+        self.color_ids = {}
+
+        self.owner = None # node whose commands are being added, set by paint_tree
+
+        # viewport index, built lazily
+        self.sorted_tops = None # tops of the short commands, sorted
+        self.order = None # command index of each entry in sorted_tops
+        self.reach = None # running max of the bottoms of the short commands, in the same order as sorted_tops
+        self.tall = None # indices of the commands taller than TALL_COMMAND_HEIGHT
+
+    def __len__(self):
+        return len(self.ops)
+
+    # display lists are pickled to send them from renderer processes to the browser. fonts only mean something in
+    # the process that made them, so they travel as their FONTS keys and get looked up again on arrival
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        font_keys = {id(font): key for key, (font, label) in FONTS.items()}
+        state['font_table'] = [font_keys.get(id(font)) for font in self.font_table]
+        state['font_ids'] = None
+        state['owner'] = None
+        state['sorted_tops'] = state['order'] = state['reach'] = state['tall'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.font_table = [None if key is None else get_font(*key) for key in self.font_table]
+        self.font_ids = {id(font): i for i, font in enumerate(self.font_table)}
+
+    # the columns plus the string and color tables. fonts are shared with every other display list
+    def nbytes(self):
+        columns = [self.ops, self.lefts, self.tops, self.rights, self.bottoms, self.strings, self.fonts,
+                   self.colors, self.thicknesses, self.owners]
+        size = sum(column.itemsize * len(column) for column in columns)
+        size += sum(sys.getsizeof(string) for string in self.string_table)
+        size += sys.getsizeof(self.string_table) + sys.getsizeof(self.string_ids)
+        size += sys.getsizeof(self.color_table) + sys.getsizeof(self.color_ids)
+        return size
+
+    def add(self, op, left, top, right, bottom, string='', font=None, color='black', thickness=0):
+        string_id = self.string_ids.get(string)
+        if string_id is None:
+            string_id = self.string_ids[string] = len(self.string_table)
+            self.string_table.append(string)
+        font_id = self.font_ids.get(id(font))
+        if font_id is None:
+            font_id = self.font_ids[id(font)] = len(self.font_table)
+            self.font_table.append(font)
+        color_id = self.color_ids.get(color)
+        if color_id is None:
+            color_id = self.color_ids[color] = len(self.color_table)
+            self.color_table.append(color)
+
+        self.ops.append(op)
+        self.lefts.append(left)
+        self.tops.append(top)
+        self.rights.append(right)
+        self.bottoms.append(bottom)
+        self.strings.append(string_id)
+        self.fonts.append(font_id)
+        self.colors.append(color_id)
+        self.thicknesses.append(thickness)
+        self.owners.append(id(self.owner))
+        self.sorted_tops = None
+
+    # callers that already laid the text out pass in its size so it doesn't have to be measured again
+    def text(self, x1, y1, text, font, color, width=None, height=None):
+        if width is None:
+            width = font.measure(text)
+        if height is None:
+            height = font.metrics('linespace')
+        self.add(DRAW_TEXT, x1, y1, x1 + width, y1 + height, text, font, color)
+
+    def rect(self, rect, color):
+        self.add(DRAW_RECT, rect.left, rect.top, rect.right, rect.bottom, color=color)
+
+    def outline(self, rect, color, thickness):
+        self.add(DRAW_OUTLINE, rect.left, rect.top, rect.right, rect.bottom, color=color, thickness=thickness)
+
+    def line(self, x1, y1, x2, y2, color, thickness):
+        self.add(DRAW_LINE, x1, y1, x2, y2, color=color, thickness=thickness)
+
+    # create the canvas item for command i
+    def execute(self, i, scroll, canvas, tags=()):
+        op = self.ops[i]
+        left, top, right, bottom = self.lefts[i], self.tops[i] - scroll, self.rights[i], self.bottoms[i] - scroll
+        color = self.color_table[self.colors[i]]
+        if op == DRAW_TEXT:
+            return canvas.create_text(left, top, text=self.string_table[self.strings[i]],
+                                      font=self.font_table[self.fonts[i]], anchor='nw', fill=color, tags=tags)
+        elif op == DRAW_RECT:
+            return canvas.create_rectangle(left, top, right, bottom, width=0, fill=color, tags=tags)
+        elif op == DRAW_OUTLINE:
+            return canvas.create_rectangle(left, top, right, bottom, width=self.thicknesses[i], outline=color,
+                                           tags=tags)
+        else:
+            return canvas.create_line(left, top, right, bottom, fill=color, width=self.thicknesses[i], tags=tags)
+
+    # update an existing canvas item to match command i instead of recreating it
+    def update(self, i, scroll, canvas, item):
+        op = self.ops[i]
+        left, top, right, bottom = self.lefts[i], self.tops[i] - scroll, self.rights[i], self.bottoms[i] - scroll
+        color = self.color_table[self.colors[i]]
+        if op == DRAW_TEXT:
+            canvas.coords(item, left, top)
+            canvas.itemconfig(item, text=self.string_table[self.strings[i]],
+                              font=self.font_table[self.fonts[i]], fill=color)
+        else:
+            canvas.coords(item, left, top, right, bottom)
+            if op == DRAW_RECT:
+                canvas.itemconfig(item, fill=color)
+            elif op == DRAW_OUTLINE:
+                canvas.itemconfig(item, width=self.thicknesses[i], outline=color)
+            else:
+                canvas.itemconfig(item, fill=color, width=self.thicknesses[i])
+
+    # everything that affects how command i looks
+    def attributes(self, i):
+        return (self.ops[i], self.lefts[i], self.tops[i], self.rights[i], self.bottoms[i],
+                self.string_table[self.strings[i]], id(self.font_table[self.fonts[i]]),
+                self.color_table[self.colors[i]], self.thicknesses[i])
+
+    def build_index(self):
+        tops, bottoms = self.tops, self.bottoms
+        short = [i for i in range(len(self.ops)) if bottoms[i] - tops[i] <= TALL_COMMAND_HEIGHT]
+        self.tall = [i for i in range(len(self.ops)) if bottoms[i] - tops[i] > TALL_COMMAND_HEIGHT]
+        short.sort(key=tops.__getitem__)
+        self.order = array.array('L', short)
+        self.sorted_tops = array.array('f', [tops[i] for i in short])
+
+        # reach only grows, so it can be bisected too. since every short command is at most TALL_COMMAND_HEIGHT
+        # tall, the search starts at most that far above the window
+        self.reach = array.array('f')
+        reach = float('-inf')
+        for i in short:
+            reach = max(reach, bottoms[i])
+            self.reach.append(reach)
+
+    # indices of the commands overlapping top..bottom, in paint order
+    def visible(self, top, bottom):
+        if self.sorted_tops is None:
+            self.build_index()
+        start = bisect.bisect_left(self.reach, top)
+        end = bisect.bisect_right(self.sorted_tops, bottom)
+        out = [i for i in self.order[start:end] if self.bottoms[i] >= top]
+        for i in self.tall:
+            if self.tops[i] <= bottom and self.bottoms[i] >= top:
+                out.append(i)
+        out.sort()
+        return out
+
+# matches up the commands of two display lists. a command is identified by the node that painted it, its opcode and
+# how many commands with that opcode the node painted before it. matching commands whose attributes differ are "changed"
+class DisplayListDiff:
+    def __init__(self, old, new, matched=None, changed=None):
+        self.old = old
+        self.new = new
+        self.matched = {} # new command index -> old command index
+        self.changed = set() # new command indices whose canvas item needs updating
+
+        # a renderer process already worked these out, see RemoteTab
+        if matched is not None:
+            self.matched, self.changed = matched, changed
+            return
+
+        old_by_key = dict(self.keyed(old))
+        for key, i in self.keyed(new):
+            old_i = old_by_key.get(key)
+            if old_i is None:
+                continue
+            self.matched[i] = old_i
+            if new.attributes(i) != old.attributes(old_i):
+                self.changed.add(i)
+
+    @staticmethod
+    def keyed(display_list):
+        counts = {}
+        for i in range(len(display_list)):
+            key = (display_list.owners[i], display_list.ops[i])
+            n = counts.get(key, 0)
+            counts[key] = n + 1
+            yield key + (n,), i
+
+# retained-mode drawing: every display list command that is near the viewport owns a canvas item that
+# stays on the canvas between frames. scrolling just moves the existing items
+class CanvasLayer:
+    def __init__(self, canvas, tag):
+        self.canvas = canvas
+        self.tag = tag # every item in this layer carries this tag so the layer can be moved as one
+        self.display_list = None
+        self.items = {} # display list command index -> canvas item id
+        self.scroll = 0 # scroll offset the current items were positioned with
+        self.stats = {'created': 0, 'updated': 0, 'deleted': 0} # canvas work done in the last frame
+
+    def clear(self):
+        self.stats['deleted'] += len(self.items)
+        self.canvas.delete(self.tag)
+        self.items = {}
+
+    # top and bottom are the visible part of the page in page coordinates. diff, if given, says how
+    # display_list differs from the previous one so that unchanged items can be kept
+    def draw(self, display_list, scroll, top, bottom, diff=None):
+        self.stats = {'created': 0, 'updated': 0, 'deleted': 0}
+
+        if scroll != self.scroll:
+            self.canvas.move(self.tag, 0, self.scroll - scroll)
+            self.scroll = scroll
+
+        # a different display list means the page was re-rendered (or the tab changed)
+        if display_list is not self.display_list:
+            if diff is not None and diff.old is self.display_list:
+                self.apply_diff(diff)
+            else:
+                self.clear()
+            self.display_list = display_list
+
+        # create items entering the buffered window and destroy the ones that left it
+        window_top = top - SCROLL_BUFFER
+        window_bottom = bottom + SCROLL_BUFFER
+        visible = display_list.visible(window_top, window_bottom)
+
+        in_window = set(visible)
+        for i in [i for i in self.items if i not in in_window]:
+            self.canvas.delete(self.items.pop(i))
+            self.stats['deleted'] += 1
+
+        # walk backwards so new items can be slid under whatever is painted after them
+        above = None
+        for i in reversed(visible):
+            item = self.items.get(i)
+            if item is None:
+                item = display_list.execute(i, scroll, self.canvas, self.tag)
+                if above is not None:
+                    self.canvas.tag_lower(item, above)
+                self.items[i] = item
+                self.stats['created'] += 1
+            above = item
+
+    # hand the canvas items of the old display list over to the matching new commands
+    def apply_diff(self, diff):
+        items = {}
+        for i, old_i in diff.matched.items():
+            item = self.items.pop(old_i, None)
+            if item is None:
+                continue
+            if i in diff.changed:
+                diff.new.update(i, self.scroll, self.canvas, item)
+                self.stats['updated'] += 1
+            items[i] = item
+
+        for item in self.items.values():
+            self.canvas.delete(item)
+        self.stats['deleted'] += len(self.items)
+        self.items = items
 
 class CssParser:
     def __init__(self, s):
@@ -1132,6 +2280,10 @@ class TagSelector:
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
 
+    # any element this selector matches has this tag
+    def subject_tag(self):
+        return self.tag
+
 class DescendantSelector:
     def __init__(self, ancestor, descendant):
         self.ancestor = ancestor
@@ -1145,6 +2297,9 @@ class DescendantSelector:
             node = node.parent
         return False
 
+    def subject_tag(self):
+        return self.descendant.subject_tag()
+
 def style(node, rules):
     node.style = {}
 
@@ -1180,25 +2335,111 @@ def style(node, rules):
     for child in node.children:
         style(child, rules)
 
+# contexts are created ahead of time, before the page they will belong to exists, so tab is set later by attach()
 class JsContext:
-    def __init__(self, tab):
-        self.tab = tab
-        self.interp = dukpy.JSInterpreter()
-        self.interp.export_function('log', print)
-        self.interp.export_function('querySelectorAll', self.querySelectorAll)
-        self.interp.export_function('getAttribute', self.getAttribute)
-        self.interp.export_function('innerHTML_set', self.innerHTML_set)
+    def __init__(self):
+        import dukpy
+        start = time.perf_counter()
+        self.tab = None
+        if SCRIPT_TIMEOUT_SEC is None:
+            self.interp = dukpy.JSInterpreter()
+        else:
+            self.interp = IsolatedInterpreter(SCRIPT_TIMEOUT_SEC)
+
+        # how many times each bridge function was called from js, plus 'evaljs' for the calls into js
+        self.bridge_calls = collections.Counter()
+        self.batched_ops = 0
+
+        self.export('log', print)
+        self.export('querySelectorAll', self.querySelectorAll)
+        self.export('getAttribute', self.getAttribute)
+        self.export('innerHTML_set', self.innerHTML_set)
+        self.export('batch', self.batch)
+        self.export('XMLHttpRequest_send', self.XMLHttpRequest_send)
+        self.export('setTimeout', self.setTimeout)
+        self.export('requestAnimationFrame', self.requestAnimationFrame)
+        self.export('releaseHandle', self.releaseHandle)
+
+        # dom operations that scripts can queue up and send over in one batch call
+        self.batchable = {
+            'querySelectorAll': self.querySelectorAll,
+            'getAttribute': self.getAttribute,
+            'innerHTML_set': self.innerHTML_set,
+        }
+
+        # handle-to-node map (js to python). these are weak, so a node that leaves the document can be freed.
+        # nodes that js still has Node objects for are kept alive by js_refs until js lets go of them
+        self.node_to_handle = weakref.WeakKeyDictionary()
+        self.handle_to_node = weakref.WeakValueDictionary()
+        self.js_refs = {} # handle -> [node, number of live Node objects in js]
+        self.finalizers = {} # handle -> weakref.finalize that reports the node's death, detached on close
+        self.next_handle = 0
+        self.dead_handles = [] # handles of freed nodes that js may still have event listeners for
+
+        if isinstance(self.interp, IsolatedInterpreter):
+            # the child may still be starting up, which isn't the page's fault, so setup gets no deadline
+            self.interp.eval(asset('runtime.js'), {}, None)
+        else:
+            self.interp.evaljs(asset('runtime.js'))
+
+        # interpreter setup is timed separately from the page's own scripts
+        self.setup_time = time.perf_counter() - start
+        self.script_time = 0
+
+        # name of each script, handler or callback -> how often it ran, how long it took and the bridge calls it made
+        self.profile = {}
 
-        # handle-to-node map (js to python)
-        self.node_to_handle = {}
-        self.handle_to_node = {}
+    def attach(self, tab):
+        self.tab = tab
 
-        self.interp.evaljs(RUNTIME_JS)
+    # called when the page goes away
+    def close(self):
+        if isinstance(self.interp, IsolatedInterpreter):
+            self.interp.close()
+        # the finalizer registry would otherwise keep this context, and through js_refs the old page, alive
+        for finalizer in self.finalizers.values():
+            finalizer.detach()
+        self.finalizers.clear()
+        self.js_refs.clear()
+
+    # every crossing from js into python goes through here so it can be counted
+    def export(self, name, function):
+        def counted(*args):
+            self.bridge_calls[name] += 1
+            return function(*args)
+        self.interp.export_function(name, counted)
+
+    def evaljs(self, code, **kwargs):
+        self.bridge_calls['evaljs'] += 1
+        return self.interp.evaljs(code, **kwargs)
+
+    # the python side of the handle tables. the js heap can't be seen from here
+    def handle_table_bytes(self):
+        return (sys.getsizeof(self.node_to_handle.data) + sys.getsizeof(self.handle_to_node.data) +
+                dict_bytes(self.js_refs) + dict_bytes(self.finalizers) + sys.getsizeof(self.dead_handles))
+
+    def bridge_stats(self):
+        stats = dict(self.bridge_calls)
+        stats['batched_ops'] = self.batched_ops
+        return stats
+
+    # run a list of [operation, args...] queued up by a DomBatch in runtime.js, returning each result
+    def batch(self, ops):
+        results = []
+        for op in ops:
+            name, args = op[0], op[1:]
+            results.append(self.batchable[name](*args))
+        self.batched_ops += len(ops)
+        return results
 
     def querySelectorAll(self, selector_text):
-        selector = CssParser(selector_text).selector()
+        selector = SELECTOR_CACHE.get(selector_text)
+        if selector is None:
+            selector = SELECTOR_CACHE[selector_text] = CssParser(selector_text).selector()
 
-        nodes = [node for node in tree_to_list(self.tab.nodes, []) if selector.matches(node)]
+        # only elements with the right tag can match, so only look at those
+        candidates = self.tab.dom_index.elements(selector.subject_tag())
+        nodes = [node for node in candidates if selector.matches(node)]
 
         return [self.get_handle(node) for node in nodes]
 
@@ -1207,45 +2448,374 @@ class JsContext:
         attr = elt.attributes.get(attr, None)
         return attr if attr else ''
 
+    # every handle given to js gets wrapped in exactly one Node object, which calls releaseHandle when it is
+    # garbage collected
     def get_handle(self, elt):
         if elt not in self.node_to_handle:
-            handle = len(self.node_to_handle)
+            handle = self.next_handle
+            self.next_handle += 1
             self.node_to_handle[elt] = handle
             self.handle_to_node[handle] = elt
+            self.finalizers[handle] = weakref.finalize(elt, self.handle_died, handle)
         else:
             handle = self.node_to_handle[elt]
+        ref = self.js_refs.setdefault(handle, [elt, 0])
+        ref[1] += 1
         return handle
 
+    def handle_died(self, handle):
+        del self.finalizers[handle]
+        self.dead_handles.append(handle)
+
+    def releaseHandle(self, handle):
+        ref = self.js_refs.get(handle)
+        if ref is None:
+            return
+        ref[1] -= 1
+        if ref[1] == 0:
+            del self.js_refs[handle]
+
     def innerHTML_set(self, handle, s):
-        doc = HtmlParser('<html><body>' + s + '</body></html>').parse()
-        new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
-        elt.children = new_nodes
         for child in elt.children:
-            child.parent = elt
+            self.tab.dom_index.remove_tree(child)
+        elt.children = []
+        HtmlParser(s).parse_fragment(elt)
+        for child in elt.children:
+            self.tab.dom_index.add_tree(child)
 
-        self.tab.render()
+        self.tab.set_needs_subtree_render(elt)
 
-    def XMLHttpRequest_send(self, method, url, body):
+    # async requests return straight away. their response is handed to js later, on the main thread, by xhr_onload
+    def XMLHttpRequest_send(self, method, url, body, is_async, handle):
         full_url = self.tab.url.resolve(url)
         if not self.tab.allowed_request(full_url):
             raise Exception("Cross-origin XHR blocked by CSP")
         if full_url.origin() != self.tab.url.origin():
             raise Exception('Cross-origin XHR request not allowed')
-        headers, out = full_url.request(self.tab.url, body)
-        return out
+        if not is_async:
+            headers, out = full_url.request(self.tab.url, body)
+            return out
+        future = REQUEST_POOL.fetch(full_url, self.tab.url, body)
+        self.tab.task_runner.schedule_background(future, lambda future: self.xhr_onload(handle, future))
+
+    def xhr_onload(self, handle, future):
+        if self.tab.js is not self:
+            return # the page that sent the request is gone
+        try:
+            headers, out = future.result()
+        except Exception as e:
+            print('XHR', handle, 'failed', e)
+            out = None
+        self.run('XHR onload', '__runXHROnload(dukpy.out, dukpy.handle)', out=out, handle=handle)
+
+    # also used for setInterval, which js re-arms after each run
+    def setTimeout(self, handle, delay):
+        self.tab.task_runner.schedule_timer(delay, lambda: self.run_timer(handle))
+
+    def run_timer(self, handle):
+        if self.tab.js is not self:
+            return
+        # returns the delay until the next run for intervals, or -1 if the timer is done (or was cleared)
+        delay = self.run('timer', '__runTimer(dukpy.handle)', handle=handle)
+        if delay is not None and delay >= 0:
+            self.setTimeout(handle, delay)
+
+    def requestAnimationFrame(self):
+        self.tab.set_needs_animation_frame()
+
+    def run_animation_frame(self):
+        self.run('requestAnimationFrame', '__runRAFHandlers(dukpy.time)', time=time.perf_counter() * 1000)
 
     def dispatch_event(self, type, elt):
-        handle = self.node_to_handle.get(elt, -1)
-        do_default = self.interp.evaljs(EVENT_DISPATCH_JS, type=type, handle=handle)
+        # js has never seen this node, so it can't have listeners
+        if elt not in self.node_to_handle:
+            return False
+        handle = self.get_handle(elt)
+        name = '{} handler on {}'.format(type, elt)
+        do_default = self.run(name, EVENT_DISPATCH_JS, type=type, handle=handle)
+        if do_default is None: # the handler crashed, carry on as if it wasn't there
+            return False
         return not do_default
 
-    # don't allow js crashes to take the browser with it
-    def run(self, script, code):
+    # don't allow js crashes (or hangs) to take the browser with it
+    def run(self, script, code, **kwargs):
+        with trace('run script', 'js', script=script):
+            import dukpy
+            start = time.perf_counter()
+            calls_before = self.js_to_python_calls()
+            try:
+                if self.dead_handles:
+                    handles, self.dead_handles = self.dead_handles, []
+                    self.evaljs('__forgetHandles(dukpy.handles)', handles=handles)
+                return self.evaljs(code, **kwargs)
+            except dukpy.JSRuntimeError as e:
+                print('Script', script, 'crashed', e)
+            except ScriptTimeout as e:
+                print('Script', script, 'stopped:', e)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.script_time += elapsed
+                self.record(script, elapsed, self.js_to_python_calls() - calls_before)
+
+    def js_to_python_calls(self):
+        return sum(self.bridge_calls.values()) - self.bridge_calls['evaljs']
+
+    def record(self, name, elapsed, bridge_calls):
+        entry = self.profile.setdefault(name, {'runs': 0, 'time_ms': 0, 'max_ms': 0, 'bridge_calls': 0})
+        entry['runs'] += 1
+        entry['time_ms'] += elapsed * 1000
+        entry['max_ms'] = max(entry['max_ms'], elapsed * 1000)
+        entry['bridge_calls'] += bridge_calls
+
+    # the page's scripts and handlers, most expensive first
+    def profile_report(self):
+        return sorted(self.profile.items(), key=lambda item: item[1]['time_ms'], reverse=True)
+
+class ScriptTimeout(Exception):
+    pass
+
+# a js interpreter in a child process, with the same interface as dukpy.JSInterpreter. calls to exported functions
+# are sent back to this process to run. if a call to evaljs takes longer than the timeout (not counting time spent in
+# exported functions) the child is killed, and the page gets no more js
+class IsolatedInterpreter:
+    def __init__(self, timeout):
+        import multiprocessing
+        self.timeout = timeout
+        self.functions = {}
+        # spawned, not forked, like renderers: JsContextPool builds these on a background thread
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_isolated_interpreter, args=(child_conn,), daemon=True)
+        self.process.start()
+        self.stopped = False
+
+    def export_function(self, name, function):
+        self.functions[name] = function
+        self.conn.send(('export', name))
+
+    def close(self):
+        self.process.kill()
+        self.stopped = True
+
+    def evaljs(self, code, **kwargs):
+        return self.eval(code, kwargs, self.timeout)
+
+    # like evaljs, but with the timeout given, or no timeout at all if it's None
+    def eval(self, code, kwargs, timeout):
+        if self.stopped:
+            raise ScriptTimeout('scripts on this page were stopped')
+        self.conn.send(('eval', code, kwargs))
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        while True:
+            if deadline is not None and not self.conn.poll(max(deadline - time.perf_counter(), 0)):
+                self.process.kill()
+                self.stopped = True
+                raise ScriptTimeout('took longer than {} seconds'.format(timeout))
+            message = self.conn.recv()
+            if message[0] == 'call':
+                call_start = time.perf_counter()
+                name, args = message[1], message[2]
+                try:
+                    self.conn.send(('result', self.functions[name](*args)))
+                except Exception as e:
+                    self.conn.send(('error', str(e)))
+                if deadline is not None:
+                    deadline += time.perf_counter() - call_start
+            elif message[0] == 'result':
+                return message[1]
+            else:
+                import dukpy
+                raise dukpy.JSRuntimeError(message[1])
+
+# the child process side of IsolatedInterpreter
+def run_isolated_interpreter(conn):
+    import dukpy
+    interp = dukpy.JSInterpreter()
+
+    def proxy(name):
+        def call(*args):
+            conn.send(('call', name, args))
+            kind, value = conn.recv()
+            if kind == 'error':
+                raise Exception(value)
+            return value
+        return call
+
+    while True:
+        message = conn.recv()
+        if message[0] == 'export':
+            interp.export_function(message[1], proxy(message[1]))
+        else:
+            try:
+                conn.send(('result', interp.evaljs(message[1], **message[2])))
+            except dukpy.JSRuntimeError as e:
+                conn.send(('error', str(e)))
+
+# work a tab has to do on the main thread, queued up from anywhere (including other threads) and run by the
+# browser's frame loop
+class TaskRunner:
+    def __init__(self, tab):
+        self.tab = tab
+        self.lock = threading.Lock()
+        self.tasks = collections.deque()
+        self.in_flight = 0 # background work that will queue a task when it finishes
+        self.timers = [] # heap of (due time, tiebreak, task)
+        self.timer_ids = itertools.count()
+
+    def schedule_task(self, task):
+        with self.lock:
+            self.tasks.append(task)
+
+    # queue callback(future) as a task once the future is done
+    def schedule_background(self, future, callback):
+        with self.lock:
+            self.in_flight += 1
+
+        def done(future):
+            with self.lock:
+                self.in_flight -= 1
+                self.tasks.append(lambda: callback(future))
+        future.add_done_callback(done)
+
+        if self.tab.browser:
+            self.tab.browser.schedule_frame()
+
+    # queue task once delay_ms have passed
+    def schedule_timer(self, delay_ms, task):
+        due = time.perf_counter() + max(delay_ms, 0) / 1000
+        with self.lock:
+            heapq.heappush(self.timers, (due, next(self.timer_ids), task))
+        if self.tab.browser:
+            self.tab.browser.schedule_frame(delay_ms)
+
+    # milliseconds until the next timer is due, or None if there are no timers
+    def next_timer_delay(self):
+        with self.lock:
+            if not self.timers:
+                return None
+            return max(0, (self.timers[0][0] - time.perf_counter()) * 1000)
+
+    # tasks that are ready or will be soon. timers don't count until they are due
+    def pending(self):
+        with self.lock:
+            return bool(self.tasks) or self.in_flight > 0
+
+    def run(self):
+        now = time.perf_counter()
+        with self.lock:
+            tasks, self.tasks = self.tasks, collections.deque()
+            while self.timers and self.timers[0][0] <= now:
+                tasks.append(heapq.heappop(self.timers)[2])
+        for task in tasks:
+            task()
+
+# runs requests on background threads, never more than per_origin at a time for the same origin.
+# requests over the limit wait their turn without taking up a thread
+class RequestPool:
+    def __init__(self, workers, per_origin):
+        self.workers = workers
+        self.executor = None # started by the first fetch
+        self.per_origin = per_origin
+        self.lock = threading.Lock()
+        self.active = {} # origin -> requests running
+        self.waiting = {} # origin -> requests queued up behind them
+        self.preloads = {} # url -> future for a request the preload scanner started and nobody has taken yet
+
+    # returns a future for the (headers, body) of the response
+    def fetch(self, url, referrer, payload=None):
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        job = (url, referrer, payload, future)
+        origin = url.origin()
+        with self.lock:
+            if self.active.get(origin, 0) >= self.per_origin:
+                self.waiting.setdefault(origin, collections.deque()).append(job)
+                return future
+            self.active[origin] = self.active.get(origin, 0) + 1
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.executor.submit(self.run, job)
+        return future
+
+    # start fetching url before anyone asks for it. the response is claimed with take
+    def preload(self, url, referrer):
+        with self.lock:
+            if str(url) in self.preloads:
+                return
+        future = self.fetch(url, referrer)
+        with self.lock:
+            self.preloads[str(url)] = future
+
+    # the future for url's preloaded response, or None if it wasn't preloaded
+    def take(self, url):
+        with self.lock:
+            return self.preloads.pop(str(url), None)
+
+    def run(self, job):
+        url, referrer, payload, future = job
         try:
-            return self.interp.evaljs(code)
-        except dukpy.JSRuntimeError as e:
-            print('Script', script, 'crashed', e)
+            future.set_result(url.request(referrer, payload))
+        except Exception as e:
+            future.set_exception(e)
+
+        # hand this origin's slot to the next request waiting for it
+        origin = url.origin()
+        with self.lock:
+            waiting = self.waiting.get(origin)
+            if waiting:
+                next_job = waiting.popleft()
+            else:
+                next_job = None
+                self.active[origin] -= 1
+        if next_job:
+            self.executor.submit(self.run, next_job)
+
+REQUEST_POOL = RequestPool(REQUEST_WORKERS, REQUESTS_PER_ORIGIN)
+
+# keeps a few fresh js contexts ready so that navigating doesn't have to wait for an interpreter to be set up.
+# contexts are never reused between pages, every page gets one that no other page has touched
+class JsContextPool:
+    def __init__(self, size):
+        self.size = size
+        self.ready = []
+        self.lock = threading.Lock()
+        self.filling = False
+
+    def acquire(self, tab):
+        with self.lock:
+            context = self.ready.pop(0) if self.ready else None
+        if context is None:
+            context = JsContext() # pool ran dry, so the page pays for the setup
+        self.refill()
+        context.attach(tab)
+        return context
+
+    # top the pool back up on a background thread
+    def refill(self):
+        with self.lock:
+            if self.filling or len(self.ready) >= self.size:
+                return
+            self.filling = True
+        threading.Thread(target=self.fill, daemon=True).start()
+
+    # a context that fails to set up stops this round of filling, and the next refill tries again
+    def fill(self):
+        try:
+            while True:
+                with self.lock:
+                    if len(self.ready) >= self.size:
+                        return
+                context = JsContext()
+                with self.lock:
+                    self.ready.append(context)
+        except Exception as e:
+            print('Could not set up a JS context for the pool:', e)
+        finally:
+            with self.lock:
+                self.filling = False
+
+JS_POOL = JsContextPool(JS_POOL_SIZE)
 
 def cascade_priority(rule):
     selector, body = rule
@@ -1257,21 +2827,143 @@ def tree_to_list(tree, list):
         tree_to_list(child, list)
     return list
 
+# sort key that puts nodes in document order
+# lay block out again after its contents changed, then move everything after it by however much its height changed
+def relayout(block):
+    old_height = block.height
+    block.children = []
+    block.layout()
+    dy = block.height - old_height
+
+    child, parent = block, block.parent
+    while parent and dy:
+        for sibling in parent.children[parent.children.index(child) + 1:]:
+            translate(sibling, dy)
+        parent.height += dy
+        child, parent = parent, parent.parent
+
+def translate(layout_object, dy):
+    layout_object.y += dy
+    for child in layout_object.children:
+        translate(child, dy)
+
 def paint_tree(layout_object, display_list):
     if layout_object.should_paint():
-        display_list.extend(layout_object.paint())
+        display_list.owner = layout_object.node
+        layout_object.paint(display_list)
 
     for child in layout_object.children:
         paint_tree(child, display_list)
 
+def object_bytes(obj):
+    return sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+
+# a dict and the values in it
+def dict_bytes(d):
+    return sys.getsizeof(d) + sum(sys.getsizeof(value) for value in d.values())
+
+# which subsystem memory allocated by a class or function belongs to, see traced_allocations. names are split into
+# words (JsContextPool is js, context, pool) and the first rule with a word in common wins, so new code is covered
+# as long as its name says what it's for. anything no rule matches is reported as 'other (name)' so it stands out
+MEMORY_SUBSYSTEMS = [
+    ('display list', {'display', 'paint'}),
+    ('layout', {'layout', 'relayout', 'translate', 'rect'}),
+    ('style', {'css', 'selector', 'style', 'cascade'}),
+    ('fonts', {'font', 'word', 'metrics'}),
+    ('canvas', {'canvas', 'chrome'}),
+    ('js', {'js', 'interpreter'}),
+    ('network', {'url', 'request', 'network', 'preload', 'csp'}),
+    ('tracing', {'trace', 'tracer', 'tracing', 'span'}),
+    ('tabs', {'tab', 'renderer'}),
+    ('tasks', {'task'}),
+    ('browser', {'browser'}),
+    ('assets', {'asset'}),
+    ('memory accounting', {'bytes', 'regions', 'allocations', 'subsystem'}),
+    ('dom', {'html', 'dom', 'element', 'text', 'tag', 'tree', 'node'}),
+]
+
+def memory_subsystem(name):
+    import re
+    words = {word.lower() for word in re.findall('[A-Z]?[a-z]+|[A-Z]+(?![a-z])', name)}
+    for subsystem, keywords in MEMORY_SUBSYSTEMS:
+        if words & keywords:
+            return subsystem
+    return 'other ({})'.format(name)
+
+CODE_REGIONS = [] # (first line, last line, name of the top level class or function) for this file, sorted
+
+def code_regions():
+    if not CODE_REGIONS:
+        for name, value in list(globals().items()):
+            if getattr(value, '__module__', None) != __name__:
+                continue
+            if isinstance(value, type):
+                functions = [getattr(f, '__func__', f) for f in vars(value).values()] # unwrap staticmethods
+            else:
+                functions = [value]
+            for function in functions:
+                if not hasattr(function, '__code__'):
+                    continue
+                code = function.__code__
+                lines = [line for start, end, line in code.co_lines() if line is not None]
+                CODE_REGIONS.append((code.co_firstlineno, max(lines, default=code.co_firstlineno), name))
+        CODE_REGIONS.sort()
+    return CODE_REGIONS
+
+# memory allocated by this file that's still alive, as {subsystem: {'bytes', 'blocks'}}. allocations are put down
+# to the class or function that made them. only works if tracemalloc was started (python -X tracemalloc), and
+# covers every tab at once since they share the heap
+def traced_allocations():
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        return None
+    regions = code_regions()
+    starts = [region[0] for region in regions]
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, __file__)])
+    totals = {}
+    for stat in snapshot.statistics('lineno'):
+        line = stat.traceback[0].lineno
+        i = bisect.bisect_right(starts, line) - 1
+        name = regions[i][2] if i >= 0 and regions[i][1] >= line else None
+        if name is None:
+            subsystem = 'module' # classes, constants and so on
+        else:
+            subsystem = memory_subsystem(name)
+        total = totals.setdefault(subsystem, {'bytes': 0, 'blocks': 0})
+        total['bytes'] += stat.size
+        total['blocks'] += stat.count
+    return totals
+
 def print_tree(node, indent=0):
     print(' ' * indent, node)
     for child in node.children:
         print_tree(child, indent+2)
 
-DEFAULT_STYLE_SHEET = CssParser(open('browser.css').read()).parse() # browser style sheet - defines default styles
+def asset(name):
+    if name not in ASSETS:
+        with open(os.path.join(ASSET_DIR, name)) as f:
+            ASSETS[name] = f.read()
+    return ASSETS[name]
+
+DEFAULT_STYLE_SHEET = None # browser style sheet - defines default styles. parsed on first use
+
+def default_style_sheet():
+    global DEFAULT_STYLE_SHEET
+    if DEFAULT_STYLE_SHEET is None:
+        DEFAULT_STYLE_SHEET = CssParser(asset('browser.css')).parse()
+    return DEFAULT_STYLE_SHEET
 
 if __name__ == '__main__':
-    # import sys
+    import tkinter
+    if '--trace' in sys.argv:
+        start_tracing(sys.argv[sys.argv.index('--trace') + 1])
+    if '--record' in sys.argv:
+        use_network_archive(sys.argv[sys.argv.index('--record') + 1], False)
+    elif '--replay' in sys.argv:
+        use_network_archive(sys.argv[sys.argv.index('--replay') + 1], True, REPLAY_LATENCY_MS, REPLAY_BANDWIDTH)
+    if '--memory-log' in sys.argv:
+        MEMORY_LOG = sys.argv[sys.argv.index('--memory-log') + 1]
+    if '--process-per-tab' in sys.argv:
+        PROCESS_PER_TAB = True
     Browser().new_tab(Url('http://localhost:8000/'))
     tkinter.mainloop()
\ No newline at end of file